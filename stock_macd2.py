@@ -8,7 +8,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 import yfinance as yf
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
 import warnings
+import zlib
 import requests
 from io import StringIO
 warnings.filterwarnings('ignore')
@@ -24,13 +37,336 @@ st.set_page_config(
 plt.rcParams['font.sans-serif'] = ['Arial Unicode MS', 'Microsoft JhengHei', 'DejaVu Sans']
 plt.rcParams['axes.unicode_minus'] = False
 
+# 快取存活時間（秒）
+CACHE_TTL_STOCK_LIST = 12 * 3600   # ISIN 股票清單
+CACHE_TTL_MONTHLY = 3600           # 月線歷史
+CACHE_TTL_DIVIDEND = 6 * 3600      # 股利資訊
+CACHE_TTL_DAILY = 15 * 60          # 當月日線（月中增量模式）
+CACHE_MAX_ENTRIES = 10000          # 約 1900 檔 × (月線 + 已收盤月線 + 當月日線 + 股利) 再留餘裕
+
+# 預先計算快照
+SNAPSHOT_DIR = os.environ.get('MACD_SNAPSHOT_DIR', 'scan_snapshots')
+PRECOMPUTE_RUN_AT = '14:30'        # 台股 13:30 收盤，預留資料更新時間
+HISTOGRAM_STATE_PATH = os.path.join(SNAPSHOT_DIR, 'histogram_state.json')
+SNAPSHOT_KEEP_LIVE = 20            # 即時掃描快照保留份數（僅供比較用）
+SNAPSHOT_KEEP_PUBLISHED = 60       # 排程 / 分片發布的快照保留份數
+
+# 參數掃描
+SWEEP_PERIOD = '5y'                # 需要較長的歷史才能統計後續報酬
+SWEEP_HORIZONS = (1, 3, 6)         # 訊號後第幾個月的報酬
+
+# 市場廣度
+BREADTH_STATE_PATH = os.path.join(SNAPSHOT_DIR, 'breadth_state_{universe}_{period}.json')
+BREADTH_PERIODS = {'2 年': '2y', '5 年': '5y', '10 年': '10y'}
+
+# 分片掃描（檔案式工作佇列，可多程序或多台機器共用同一個目錄）
+SHARD_QUEUE_DIR = os.environ.get('MACD_SHARD_QUEUE_DIR', 'scan_jobs')
+SHARD_STALE_SECONDS = 2 * 3600     # 執行中超過此時間視為 worker 已中斷，可重新排入佇列
+
+# 掃描結果即時匯出
+EXPORT_DIR = os.environ.get('MACD_EXPORT_DIR', 'scan_exports')
+PARQUET_BATCH_ROWS = 200           # Parquet 每累積幾筆寫出一個 row group
+
+# 掃描訊號模式：快照檔名 -> 畫面選項
+SCAN_MODES = {
+    'first_red': '🔴 第一根紅柱',
+    'macd_positive': '📈 MACD>0（多頭）',
+    'green_shrink': '🟢 綠柱縮短（預警）',
+}
+SNAPSHOT_MODE_KEYS = {label: key for key, label in SCAN_MODES.items()}
+SIGNAL_TYPES = {'first_red': '第一根紅柱', 'macd_positive': '第一根紅柱', 'green_shrink': '綠柱縮短'}
+
+
+class SharedFetchCache:
+    """跨 session 共用的下載快取（TTL + 容量上限 LRU + single-flight）
+
+    同一個 key 同時有多個請求時，只有第一個會真的去下載，
+    其餘請求等待同一筆下載結果，避免重複打 Yahoo / 證交所。
+    """
+
+    class _InFlight:
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+            self.aborted = False  # 下載者被中斷（例如 Streamlit 重跑 / 停止），沒有產生結果
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, default_ttl=CACHE_TTL_MONTHLY):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()   # key -> (到期時間, 值)
+        self._in_flight = {}            # key -> _InFlight
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch_fn, ttl=None):
+        """取得快取值；沒有（或過期）時呼叫 fetch_fn 下載。回傳 None 或空值時不寫入快取"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+            flight = self._in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = SharedFetchCache._InFlight()
+                self._in_flight[key] = flight
+
+        # 其他 session 已在下載同一筆資料，等它完成
+        if not is_leader:
+            flight.event.wait()
+            if flight.aborted:
+                # 下載者的 session 被中斷，改由自己重新下載（不把對方的中斷轉嫁給這個 session）
+                return self.get_or_fetch(key, fetch_fn, ttl)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = fetch_fn()
+            flight.value = value
+        except Exception as e:
+            flight.error = e
+            raise
+        except BaseException:
+            flight.aborted = True
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and not flight.aborted and self._is_cacheable(flight.value):
+                    self._store(key, flight.value, ttl)
+                self._in_flight.pop(key, None)
+            flight.event.set()
+
+        return value
+
+    def get(self, key):
+        """只查快取，不下載；沒有或已過期時回傳 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @staticmethod
+    def _is_cacheable(value):
+        if value is None:
+            return False
+        if isinstance(value, (dict, list, pd.DataFrame, pd.Series)) and len(value) == 0:
+            return False
+        return True
+
+    def _store(self, key, value, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        # 超過容量時，先清過期的，再依 LRU 淘汰最久未使用的
+        if len(self._entries) > self.max_entries:
+            now = time.monotonic()
+            for k in [k for k, (exp, _) in self._entries.items() if exp <= now]:
+                del self._entries[k]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+@st.cache_resource
+def get_shared_cache():
+    """整個 Streamlit 程序共用一份快取（所有使用者 session 共享）"""
+    return SharedFetchCache()
+
+
+@contextmanager
+def file_lock(path, timeout=30, stale_after=120):
+    """以 <path>.lock 做跨程序的互斥鎖（O_EXCL 建檔，本機與共用磁碟都適用）
+
+    逾時仍拿不到鎖時拋出 TimeoutError；持有超過 stale_after 秒的鎖視為程序已中斷而移除。
+    """
+    lock_path = f'{path}.lock'
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue  # 鎖剛被釋放
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"無法取得檔案鎖: {lock_path}")
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+class HistogramStateStore:
+    """記錄每檔股票最近一次掃描的月MACD柱狀體，用來決定下次掃描的優先順序
+
+    存成 JSON：{代號: {'month': 'YYYY-MM', 'hist': 當月柱狀體, 'prev_hist': 前月柱狀體, 'close': 收盤價}}
+    """
+
+    def __init__(self, path=HISTOGRAM_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = self._file_mtime()
+        self._state = self._read()
+        self._dirty = set()  # 本程序更新過、尚未寫回的代號
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _merge(self, snapshot, mtime):
+        """併入檔案內容；本程序尚未寫回的股票以記憶體中的為準"""
+        with self._lock:
+            for code, entry in snapshot.items():
+                if code not in self._dirty:
+                    self._state[code] = entry
+            self._mtime = mtime
+
+    def refresh(self):
+        """檔案被其他程序（預先計算、分片 worker）改寫過就重新讀入"""
+        mtime = self._file_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._merge(self._read(), mtime)
+
+    def update(self, stock_code, data):
+        """以計算完指標的月線資料更新該股狀態"""
+        if len(data) < 2:
+            return
+        entry = {
+            'month': data.index[-1].strftime('%Y-%m'),
+            'hist': float(data['MACD_Histogram'].iloc[-1]),
+            'prev_hist': float(data['MACD_Histogram'].iloc[-2]),
+            'close': float(data['Close'].iloc[-1]),
+        }
+        with self._lock:
+            self._state[stock_code] = entry
+            self._dirty.add(stock_code)
+
+    def get(self, stock_code):
+        with self._lock:
+            return self._state.get(stock_code)
+
+    def save(self):
+        """寫回檔案；在檔案鎖內「讀取→合併本程序更新過的股票→取代」，多個分片程序同時寫入不會互相蓋掉"""
+        with self._lock:
+            updates = {code: self._state[code] for code in self._dirty}
+            self._dirty.clear()
+        if not updates:
+            return
+        try:
+            with file_lock(self.path):
+                snapshot = self._read()
+                snapshot.update(updates)
+                tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self.path)
+                mtime = self._file_mtime()
+            self._merge(snapshot, mtime)
+        except TimeoutError:
+            # 排序狀態只影響掃描順序，拿不到鎖就留到下次再寫
+            with self._lock:
+                self._dirty.update(updates)
+
+    def priority(self, stock_code, filter_green_shrink=False, current_month=None):
+        """排序鍵（越小越先掃），依上次的柱狀體推估本次命中的可能性"""
+        entry = self.get(stock_code)
+        if entry is None:
+            return (2, 0.0)  # 沒有紀錄的排在中間
+
+        h1, h0 = entry['hist'], entry['prev_hist']
+        scale = abs(entry['close']) or 1.0
+        shrinking = h1 < 0 and h0 < 0 and abs(h1) < abs(h0)
+        current_month = current_month or datetime.now().strftime('%Y-%m')
+
+        if filter_green_shrink:
+            if shrinking:
+                return (0, -(abs(h0) - abs(h1)) / abs(h0))  # 縮短比例大的先
+            if h1 < 0:
+                return (1, abs(h1) / scale)
+            return (3, h1 / scale)
+
+        if entry['month'] == current_month and h1 > 0 and h0 <= 0:
+            return (0, -h1 / scale)  # 本月上次掃描已是第一根紅柱
+        if shrinking:
+            return (1, abs(h1) / abs(h0))  # 綠柱縮短，越接近零軸越可能翻紅
+        if h1 < 0:
+            return (3, abs(h1) / scale)
+        return (4, h1 / scale)  # 已是紅柱，本月較難再出現「第一根」
+
+    def prioritize(self, stock_codes, filter_green_shrink=False):
+        """依命中可能性重新排序股票代號（同分維持原順序）"""
+        self.refresh()
+        current_month = datetime.now().strftime('%Y-%m')
+        return sorted(
+            stock_codes,
+            key=lambda code: self.priority(code, filter_green_shrink, current_month),
+        )
+
+
+@st.cache_resource
+def get_histogram_state():
+    """整個程序共用一份柱狀體狀態"""
+    return HistogramStateStore()
+
 
 class StockListFetcher:
     """抓取完整台股清單"""
     
+    @staticmethod
+    def fetch_twse_universe():
+        """抓取上市股票基本資料（名稱、ISIN、上市日、產業），index 為 代號.TW（跨 session 快取）"""
+        return get_shared_cache().get_or_fetch(
+            ('isin', 'twse'), StockListFetcher._download_twse_stocks, ttl=CACHE_TTL_STOCK_LIST
+        ).copy()
+    
     @staticmethod
     def fetch_twse_stocks():
-        """抓取上市股票清單，回傳 {代號.TW: 中文名稱} 的 dict"""
+        """抓取上市股票清單，回傳 {代號.TW: 中文名稱} 的 dict（跨 session 快取）"""
+        universe = StockListFetcher.fetch_twse_universe()
+        return dict(zip(universe.index, universe['股票名稱']))
+    
+    @staticmethod
+    def _download_twse_stocks():
+        """從證交所 ISIN 頁面下載上市股票清單"""
         import urllib3
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         
@@ -44,27 +380,34 @@ class StockListFetcher:
             response.encoding = 'big5'
             
             tables = pd.read_html(StringIO(response.text))
-            df = tables[0]
-            df = df[df[0].str.contains('　', na=False)]
-            df[['stock_code', 'stock_name']] = df[0].str.split('　', n=1, expand=True)
-            df = df[df['stock_code'].str.match(r'^\d{4}$', na=False)]
-            df['stock_name'] = df['stock_name'].str.strip()
-            
-            stock_dict = {f"{r['stock_code']}.TW": r['stock_name'] for _, r in df.iterrows()}
+            universe = StockListFetcher._parse_isin_table(tables[0], '.TW')
             
-            if len(stock_dict) < 100:  # 如果資料太少，可能有問題
-                st.warning(f"⚠️ 上市股票數量異常: {len(stock_dict)} 檔")
+            if len(universe) < 100:  # 如果資料太少，可能有問題
+                st.warning(f"⚠️ 上市股票數量異常: {len(universe)} 檔")
             
-            return stock_dict
+            return universe
             
         except Exception as e:
             st.error(f"❌ 抓取上市股票失敗: {str(e)[:200]}")
             st.info("💡 將使用快速模式的預設清單")
-            return {}
+            return StockListFetcher._parse_isin_table(pd.DataFrame({0: []}), '.TW')
+    
+    @staticmethod
+    def fetch_tpex_universe():
+        """抓取上櫃股票基本資料（名稱、ISIN、上市日、產業），index 為 代號.TWO（跨 session 快取）"""
+        return get_shared_cache().get_or_fetch(
+            ('isin', 'tpex'), StockListFetcher._download_tpex_stocks, ttl=CACHE_TTL_STOCK_LIST
+        ).copy()
     
     @staticmethod
     def fetch_tpex_stocks():
-        """抓取上櫃股票清單，回傳 {代號.TWO: 中文名稱} 的 dict"""
+        """抓取上櫃股票清單，回傳 {代號.TWO: 中文名稱} 的 dict（跨 session 快取）"""
+        universe = StockListFetcher.fetch_tpex_universe()
+        return dict(zip(universe.index, universe['股票名稱']))
+    
+    @staticmethod
+    def _download_tpex_stocks():
+        """從證交所 ISIN 頁面下載上櫃股票清單"""
         import urllib3
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         
@@ -77,23 +420,72 @@ class StockListFetcher:
             response.encoding = 'big5'
             
             tables = pd.read_html(StringIO(response.text))
-            df = tables[0]
-            df = df[df[0].str.contains('　', na=False)]
-            df[['stock_code', 'stock_name']] = df[0].str.split('　', n=1, expand=True)
-            df = df[df['stock_code'].str.match(r'^\d{4}$', na=False)]
-            df['stock_name'] = df['stock_name'].str.strip()
+            universe = StockListFetcher._parse_isin_table(tables[0], '.TWO')
             
-            stock_dict = {f"{r['stock_code']}.TWO": r['stock_name'] for _, r in df.iterrows()}
+            if len(universe) < 50:
+                st.warning(f"⚠️ 上櫃股票數量異常: {len(universe)} 檔")
             
-            if len(stock_dict) < 50:
-                st.warning(f"⚠️ 上櫃股票數量異常: {len(stock_dict)} 檔")
-            
-            return stock_dict
+            return universe
             
         except Exception as e:
             st.error(f"❌ 抓取上櫃股票失敗: {str(e)[:200]}")
             st.info("💡 將使用快速模式的預設清單")
-            return {}
+            return StockListFetcher._parse_isin_table(pd.DataFrame({0: []}), '.TWO')
+    
+    @staticmethod
+    def _parse_isin_table(df, suffix):
+        """解析 ISIN 頁面表格：0 代號及名稱、1 ISIN、2 上市日、3 市場別、4 產業別"""
+        df = df[df[0].astype(str).str.contains('　', na=False)].copy()
+        if df.empty:
+            return pd.DataFrame(columns=['股票名稱', 'ISIN', '上市日', '產業'], index=pd.Index([], name='代號'))
+        
+        df[['stock_code', 'stock_name']] = df[0].str.split('　', n=1, expand=True)
+        df = df[df['stock_code'].str.match(r'^\d{4}$', na=False)]
+        
+        def column(i):
+            return df[i].values if i in df.columns else 'N/A'
+        
+        universe = pd.DataFrame({
+            '股票名稱': df['stock_name'].str.strip().values,
+            'ISIN': column(1),
+            '上市日': column(2),
+            '產業': column(4),
+        }, index=pd.Index(df['stock_code'] + suffix, name='代號'))
+        universe['產業'] = universe['產業'].fillna('N/A').astype(str).str.strip().replace('', 'N/A')
+        return universe
+    
+    @staticmethod
+    def get_industry_map(download=True):
+        """{代號: 產業}，取自共用快取的股票清單
+
+        download=False 時只用已快取的清單，不連線（沒有快取的股票由呼叫端補 'N/A'）
+        """
+        universe = StockListFetcher.get_universe() if download else StockListFetcher.get_cached_universe()
+        return universe['產業'].to_dict()
+
+    @staticmethod
+    def get_cached_universe():
+        """已在共用快取中的上市 / 上櫃基本資料（不連線；都沒有時回傳空表）"""
+        cache = get_shared_cache()
+        parts = [cache.get(('isin', market)) for market in ('twse', 'tpex')]
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            return StockListFetcher._parse_isin_table(pd.DataFrame({0: []}), '.TW')
+        return pd.concat(parts)
+    
+    @staticmethod
+    def get_universe():
+        """上市 + 上櫃完整基本資料（快取過期時才重新下載）"""
+        return pd.concat([StockListFetcher.fetch_twse_universe(), StockListFetcher.fetch_tpex_universe()])
+    
+    @staticmethod
+    def filter_by_industry(stock_dict, industries):
+        """在抓任何股價之前，先依產業縮小掃描範圍"""
+        if not industries:
+            return stock_dict
+        industry_map = StockListFetcher.get_universe()['產業'].to_dict()
+        selected = set(industries)
+        return {code: name for code, name in stock_dict.items() if industry_map.get(code) in selected}
     
     @staticmethod
     def get_all_tw_stocks():
@@ -159,7 +551,124 @@ class StockScanner:
     
     @staticmethod
     def fetch_monthly_data(stock_code, period='2y'):
-        """抓取月線數據"""
+        """抓取月線數據（跨 session 快取，回傳副本以免計算指標時改到快取內容）"""
+        data = get_shared_cache().get_or_fetch(
+            ('monthly', stock_code, period),
+            lambda: StockScanner._download_monthly_data(stock_code, period),
+            ttl=CACHE_TTL_MONTHLY,
+        )
+        return None if data is None else data.copy()
+    
+    @staticmethod
+    def fetch_completed_monthly_data(stock_code, period='2y', actions=()):
+        """抓取已收盤的月線（不含當月），快取到月底，月中重複掃描不必重抓歷史
+
+        actions 為當月已發生的除權息 / 分割日期。Yahoo 會以此回溯調整歷史價格，
+        快取鍵包含它，除權息後重抓一次調整後的歷史，避免與調整後的日線混用
+        """
+        now = datetime.now()
+        current_month = now.strftime('%Y-%m')
+        next_month_start = (now.replace(day=1) + timedelta(days=32)).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        cache = get_shared_cache()
+
+        def download():
+            if actions:
+                # 月線快取可能是除權息前下載的未調整價格
+                cache.invalidate(('monthly', stock_code, period))
+            data = StockScanner.fetch_monthly_data(stock_code, period)
+            if data is None:
+                return None
+            return data[data.index.strftime('%Y-%m') < current_month]
+
+        if actions:
+            cache.invalidate(('monthly_completed', stock_code, period, current_month, ()))
+        data = cache.get_or_fetch(
+            ('monthly_completed', stock_code, period, current_month, tuple(actions)),
+            download,
+            ttl=(next_month_start - now).total_seconds(),
+        )
+        return None if data is None else data.copy()
+    
+    @staticmethod
+    def fetch_current_month_daily(stock_code):
+        """抓取當月日線（月中增量模式用）
+
+        下載失敗回傳 None；下載成功但當月沒有資料回傳空的 DataFrame（空值不寫入快取）
+        """
+        month_start = datetime.now().strftime('%Y-%m-01')
+
+        def download():
+            try:
+                return yf.Ticker(stock_code).history(start=month_start, interval='1d')
+            except Exception:
+                return None
+
+        data = get_shared_cache().get_or_fetch(
+            ('daily_current', stock_code, month_start), download, ttl=CACHE_TTL_DAILY
+        )
+        return None if data is None else data.copy()
+    
+    @staticmethod
+    def corporate_actions(daily):
+        """當月日線中有除權息或分割的日期（依序），沒有則為空 tuple"""
+        mask = pd.Series(False, index=daily.index)
+        for col in ('Dividends', 'Stock Splits'):
+            if col in daily.columns:
+                mask |= daily[col].fillna(0) != 0
+        return tuple(daily.index[mask].strftime('%Y-%m-%d'))
+
+    @staticmethod
+    def build_provisional_month_bar(daily):
+        """由當月日線組出暫定的月K（開/高/低/收/量）"""
+        bar = {
+            'Open': daily['Open'].iloc[0],
+            'High': daily['High'].max(),
+            'Low': daily['Low'].min(),
+            'Close': daily['Close'].iloc[-1],
+            'Volume': daily['Volume'].sum(),
+        }
+        for col in ('Dividends', 'Stock Splits'):
+            if col in daily.columns:
+                bar[col] = daily[col].sum()
+        month_index = daily.index[0].normalize().replace(day=1)
+        return pd.DataFrame([bar], index=pd.DatetimeIndex([month_index], name=daily.index.name))
+    
+    @staticmethod
+    def fetch_monthly_data_incremental(stock_code, period='2y'):
+        """已收盤月線用快取，只抓當月日線在本地重建當月K棒"""
+        daily = StockScanner.fetch_current_month_daily(stock_code)
+        if daily is None:
+            # 日線下載失敗：不能拿上個月的訊號冒充本月結果
+            return None
+
+        completed = StockScanner.fetch_completed_monthly_data(
+            stock_code, period, StockScanner.corporate_actions(daily)
+        )
+        if completed is None:
+            return None
+        if daily.empty:
+            # 確認當月真的還沒有交易日（月線也沒有當月K棒）才只用已收盤的月線，
+            # 否則視為被限流等下載異常
+            monthly = StockScanner.fetch_monthly_data(stock_code, period)
+            current_month = datetime.now().strftime('%Y-%m')
+            if monthly is None or (monthly.index.strftime('%Y-%m') == current_month).any():
+                return None
+            data = completed
+        else:
+            bar = StockScanner.build_provisional_month_bar(daily)
+            if completed.index.tz is not None and bar.index.tz is not None:
+                bar.index = bar.index.tz_convert(completed.index.tz)
+            data = pd.concat([completed, bar])
+
+        if len(data) < 12:
+            return None
+        return data
+    
+    @staticmethod
+    def _download_monthly_data(stock_code, period='2y'):
+        """從 Yahoo 下載月線數據"""
         try:
             ticker = yf.Ticker(stock_code)
             data = ticker.history(period=period, interval='1mo')
@@ -215,7 +724,19 @@ class StockScanner:
     
     @staticmethod
     def get_dividend_info(stock_code):
-        """取得股利資訊"""
+        """取得股利資訊（跨 session 快取）"""
+        info = get_shared_cache().get_or_fetch(
+            ('dividend', stock_code),
+            lambda: StockScanner._download_dividend_info(stock_code),
+            ttl=CACHE_TTL_DIVIDEND,
+        )
+        if info is None:
+            return {'有發股利': False, '近年股利': 0, '殖利率': 0}
+        return dict(info)
+    
+    @staticmethod
+    def _download_dividend_info(stock_code):
+        """從 Yahoo 下載股利資訊，下載失敗回傳 None（不寫入快取）"""
         try:
             ticker = yf.Ticker(stock_code)
             dividends = ticker.dividends
@@ -251,7 +772,7 @@ class StockScanner:
                 '殖利率': round(dividend_yield, 2)
             }
         except:
-            return {'有發股利': False, '近年股利': 0, '殖利率': 0}
+            return None
     
     @staticmethod
     def check_first_macd_red(data):
@@ -361,170 +882,1090 @@ class StockScanner:
         return True, info
 
 
+class StreamingResultSink:
+    """掃描時逐筆把命中結果寫到檔案（CSV / JSONL / Parquet），不必等掃描結束再序列化
+
+    CSV、JSONL 每筆寫入後立即 flush，掃描途中其他程式就能讀到目前為止的結果；
+    Parquet 每 PARQUET_BATCH_ROWS 筆寫一個 row group，檔案要等 close() 寫入 footer 後才可讀取。
+    欄位以第一筆結果為準，後續多出的欄位會被忽略。
+    """
+
+    FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson', 'parquet': 'application/octet-stream'}
+
+    def __init__(self, path, fmt=None):
+        self.path = path
+        self.fmt = (fmt or os.path.splitext(path)[1].lstrip('.')).lower()
+        if self.fmt not in self.FORMATS:
+            raise ValueError(f"不支援的匯出格式: {self.fmt}")
+
+        self.count = 0
+        self._columns = None
+        self._file = None
+        self._writer = None
+        self._buffer = []
+
+        if self.fmt == 'parquet':
+            import pyarrow  # 選用套件，只有 Parquet 匯出需要
+            import pyarrow.parquet
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if self.fmt in ('csv', 'jsonl'):
+            encoding = 'utf-8-sig' if self.fmt == 'csv' else 'utf-8'
+            self._file = open(path, 'w', encoding=encoding, newline='')
+
+    @property
+    def mime(self):
+        return self.FORMATS[self.fmt]
+
+    def write(self, result):
+        """寫入一筆命中結果"""
+        if self._columns is None:
+            self._columns = list(result.keys())
+        row = {col: self._to_python(result.get(col)) for col in self._columns}
+
+        if self.fmt == 'csv':
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._file, fieldnames=self._columns)
+                self._writer.writeheader()
+            self._writer.writerow(row)
+            self._file.flush()
+        elif self.fmt == 'jsonl':
+            self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+            self._file.flush()
+        else:
+            self._buffer.append(row)
+            if len(self._buffer) >= PARQUET_BATCH_ROWS:
+                self._flush_parquet()
+
+        self.count += 1
+
+    def close(self):
+        if self.fmt == 'parquet':
+            self._flush_parquet()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _flush_parquet(self):
+        if not self._buffer:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            table = pa.Table.from_pylist(self._buffer)
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = pa.Table.from_pylist(self._buffer, schema=self._writer.schema)
+        self._writer.write_table(table)
+        self._buffer = []
+
+    @staticmethod
+    def _to_python(value):
+        # numpy 數值轉成 Python 原生型別，方便 JSON / Arrow 序列化
+        return value.item() if isinstance(value, np.generic) else value
+
+
+def analyze_stock(stock_code, stock_name, filter_green_shrink=False, incremental=False, industry='N/A'):
+    """抓取單一股票月線並判斷訊號，有訊號回傳結果 dict，否則回傳 None（不套用篩選條件）
+
+    incremental=True 時使用月中增量模式（已收盤月線快取 + 當月日線重建暫定月K）
+    """
+    # 抓取月線數據
+    if incremental:
+        data = StockScanner.fetch_monthly_data_incremental(stock_code)
+    else:
+        data = StockScanner.fetch_monthly_data(stock_code)
+    if data is None:
+        return None
+
+    # 計算技術指標
+    data = StockScanner.calculate_monthly_macd(data)
+    data = StockScanner.calculate_monthly_kd(data)
+    data = StockScanner.calculate_monthly_rsi(data)
+    get_histogram_state().update(stock_code, data)
+
+    # 依模式選擇訊號判斷邏輯
+    if filter_green_shrink:
+        is_signal, info = StockScanner.check_green_shrink(data)
+    else:
+        is_signal, info = StockScanner.check_first_macd_red(data)
+
+    if not is_signal:
+        return None
+
+    dividend_info = StockScanner.get_dividend_info(stock_code)
+
+    result = {
+        '股票代號': stock_code.replace('.TW', '').replace('.TWO', ''),
+        '股票名稱': stock_name,
+        '市場': '上市' if stock_code.endswith('.TW') else '上櫃',
+        '現價': round(data['Close'].iloc[-1], 2),
+        '當月最低價': round(data['Low'].iloc[-1], 2),
+        '產業': industry,
+        '有發股利': '✓' if dividend_info['有發股利'] else '✗',
+        '近年股利': dividend_info['近年股利'],
+        '殖利率': dividend_info['殖利率'],
+        # 當月K棒尚未收盤時訊號可能再變動，月底收盤後才算確認
+        '月線狀態': '暫定' if data.index[-1].strftime('%Y-%m') == datetime.now().strftime('%Y-%m') else '確認',
+    }
+    result.update(info)
+    return result
+
+
 def scan_all_stocks(stock_dict, progress_bar, status_text, result_container,
                     filter_macd_positive=False, filter_green_shrink=False,
                     filter_has_dividend=False, min_dividend_yield=0.0, min_signal_strength=0,
-                    min_green_shrink_pct=10.0):
-    """掃描所有股票（即時顯示結果），stock_dict = {代號: 中文名稱}"""
+                    min_green_shrink_pct=10.0, prioritize=False, max_results=0, time_budget=0,
+                    incremental=False, sink=None, first_red_results=None, industry_map=None,
+                    all_results=None):
+    """掃描所有股票（即時顯示結果），stock_dict = {代號: 中文名稱}
+
+    回傳 (結果 list, 實際掃描過的代號 list)；提前停止時後者少於 stock_dict
+
+    progress_bar / status_text / result_container 傳 None 時不更新畫面（背景程序使用）
+    prioritize=True 時依上次柱狀體狀態把可能命中的股票排前面；
+    max_results（找到幾檔就停）與 time_budget（秒）為 0 表示不限制
+    incremental=True 時使用月中增量模式（只抓當月日線）
+    sink 為 StreamingResultSink 時，每找到一檔就立即寫入檔案
+    綠柱縮短模式下傳入 first_red_results（list）時，同時記錄同一批股票的第一根紅柱結果
+    （月線已在快取中，不另外下載），供快照比較判斷「綠柱縮短→第一根紅柱」升級
+    industry_map（{代號: 產業}）未傳入時只用共用快取中已有的股票清單，不為此另外下載
+    all_results 傳入 list 時，記錄該模式所有命中的股票（未套用股利、強度等篩選條件），
+    與排程快照相同口徑，供保存快照與日後比較
+    """
     results = []
+    scanned = []
     stock_list = list(stock_dict.keys())
+    if industry_map is None:
+        industry_map = StockListFetcher.get_industry_map(download=False)
+    histogram_state = get_histogram_state()
+    if prioritize:
+        stock_list = histogram_state.prioritize(stock_list, filter_green_shrink=filter_green_shrink)
     total = len(stock_list)
     found_count = 0
+    start_time = time.monotonic()
 
     for idx, stock_code in enumerate(stock_list, 1):
+        if max_results and found_count >= max_results:
+            break
+        if time_budget and time.monotonic() - start_time > time_budget:
+            break
+        if idx % 200 == 0:
+            histogram_state.save()
+
         # 更新進度
         progress = idx / total
-        progress_bar.progress(progress)
         cn_name = stock_dict.get(stock_code, '')
-        status_text.text(f'掃描進度: {idx}/{total} ({progress*100:.1f}%)  {stock_code} {cn_name}  ｜  已找到 {found_count} 檔')
+        if progress_bar is not None:
+            progress_bar.progress(progress)
+        if status_text is not None:
+            status_text.text(f'掃描進度: {idx}/{total} ({progress*100:.1f}%)  {stock_code} {cn_name}  ｜  已找到 {found_count} 檔')
 
-        # 抓取月線數據
-        data = StockScanner.fetch_monthly_data(stock_code)
-        if data is None:
+        stock_name = stock_dict.get(stock_code, stock_code)
+        industry = industry_map.get(stock_code, 'N/A')
+        result = analyze_stock(stock_code, stock_name, filter_green_shrink=filter_green_shrink,
+                               incremental=incremental, industry=industry)
+        scanned.append(stock_code)
+        if filter_green_shrink and first_red_results is not None:
+            red_result = analyze_stock(stock_code, stock_name, incremental=incremental, industry=industry)
+            if red_result is not None:
+                first_red_results.append(red_result)
+        if result is None:
             continue
 
-        # 計算技術指標
-        data = StockScanner.calculate_monthly_macd(data)
-        data = StockScanner.calculate_monthly_kd(data)
-        data = StockScanner.calculate_monthly_rsi(data)
+        # 即時篩選（先過濾再 append，確保最終表格一致）
+        if filter_macd_positive and result['MACD位階'] != '多頭':
+            continue
+        if all_results is not None:
+            all_results.append(result)
+        if filter_green_shrink and result.get('縮短比例%', 0) < min_green_shrink_pct:
+            continue
+        if filter_has_dividend and result['有發股利'] != '✓':
+            continue
+        if min_dividend_yield > 0 and result['殖利率'] < min_dividend_yield:
+            continue
+        if result['訊號強度'] < min_signal_strength:
+            continue
 
-        # 依模式選擇訊號判斷邏輯
-        if filter_green_shrink:
-            is_signal, info = StockScanner.check_green_shrink(data)
-        else:
-            is_signal, info = StockScanner.check_first_macd_red(data)
-
-        if is_signal:
-            stock_name = stock_dict.get(stock_code, stock_code)
-            dividend_info = StockScanner.get_dividend_info(stock_code)
-
-            result = {
-                '股票代號': stock_code.replace('.TW', '').replace('.TWO', ''),
-                '股票名稱': stock_name,
-                '市場': '上市' if stock_code.endswith('.TW') else '上櫃',
-                '現價': round(data['Close'].iloc[-1], 2),
-                '當月最低價': round(data['Low'].iloc[-1], 2),
-                '產業': 'N/A',
-                '有發股利': '✓' if dividend_info['有發股利'] else '✗',
-                '近年股利': dividend_info['近年股利'],
-                '殖利率': dividend_info['殖利率'],
-            }
-            result.update(info)
+        results.append(result)
+        found_count += 1
+        if sink is not None:
+            sink.write(result)
 
-            # 即時篩選（先過濾再 append，確保最終表格一致）
-            if filter_macd_positive and result['MACD位階'] != '多頭':
-                continue
-            if filter_green_shrink and result.get('縮短比例%', 0) < min_green_shrink_pct:
-                continue
-            if filter_has_dividend and result['有發股利'] != '✓':
-                continue
-            if min_dividend_yield > 0 and result['殖利率'] < min_dividend_yield:
-                continue
-            if result['訊號強度'] < min_signal_strength:
-                continue
+        if result_container is None:
+            continue
 
-            results.append(result)
-            found_count += 1
+        # 即時顯示
+        strength = result['訊號強度']
+        icon = '💎' if strength >= 4 else '🚀' if strength == 3 else '🔥' if strength == 2 else '⚡' if strength == 1 else '💡'
+        mode_tag = '🟢縮短' if filter_green_shrink else '🔴第一紅柱'
+        macd_tag = '📈多頭' if result['MACD位階'] == '多頭' else '📉空頭'
+        div_icon = '💰' if result['有發股利'] == '✓' else '🚫'
+        div_text = f"殖利率 {result['殖利率']:.1f}%" if result['殖利率'] > 0 else "無股利"
 
-            # 即時顯示
-            strength = result['訊號強度']
-            icon = '💎' if strength >= 4 else '🚀' if strength == 3 else '🔥' if strength == 2 else '⚡' if strength == 1 else '💡'
-            mode_tag = '🟢縮短' if filter_green_shrink else '🔴第一紅柱'
-            macd_tag = '📈多頭' if result['MACD位階'] == '多頭' else '📉空頭'
-            div_icon = '💰' if result['有發股利'] == '✓' else '🚫'
-            div_text = f"殖利率 {result['殖利率']:.1f}%" if result['殖利率'] > 0 else "無股利"
+        with result_container:
+            st.success(
+                f"{icon} #{found_count}　"
+                f"**{result['股票代號']}**　{stock_name}　｜　"
+                f"💵 ${result['現價']:.2f}　｜　"
+                f"{div_icon} {div_text}　｜　"
+                f"{macd_tag}　｜　{mode_tag}　｜　"
+                f"訊號強度: {'★' * strength}{'☆' * (4 - strength)} ({strength})"
+            )
 
-            with result_container:
-                st.success(
-                    f"{icon} #{found_count}　"
-                    f"**{result['股票代號']}**　{stock_name}　｜　"
-                    f"💵 ${result['現價']:.2f}　｜　"
-                    f"{div_icon} {div_text}　｜　"
-                    f"{macd_tag}　｜　{mode_tag}　｜　"
-                    f"訊號強度: {'★' * strength}{'☆' * (4 - strength)} ({strength})"
-                )
+    histogram_state.save()
+    return results, scanned
 
-    return results
 
+def read_result_csv(path):
+    """讀回掃描結果 CSV；'N/A' 等字串保持原樣（pandas 預設會轉成 NaN），只有空欄位視為缺值"""
+    return pd.read_csv(
+        path, dtype={'股票代號': str, '股票名稱': str, '產業': str},
+        keep_default_na=False, na_values=[''], encoding='utf-8-sig',
+    )
 
-def plot_monthly_chart(data, stock_code, stock_name):
-    """繪製月線圖表"""
-    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(16, 10))
-    
-    # 子圖1：月K線圖
-    ax1.plot(data.index, data['Close'], label='月收盤價', linewidth=2, color='black')
-    ax1.scatter(data.index[-1], data['Close'].iloc[-1], 
-                color='red', s=200, zorder=5, label='當前月份')
-    ax1.set_title(f'{stock_name} ({stock_code}) - 月K線圖')
-    ax1.set_xlabel('日期')
-    ax1.set_ylabel('價格 (元)')
-    ax1.legend(loc='best')
-    ax1.grid(True, alpha=0.3)
-    
-    # 子圖2：月MACD
-    ax2.plot(data.index, data['MACD'], label='MACD', linewidth=2, color='blue')
-    ax2.plot(data.index, data['MACD_Signal'], label='Signal', linewidth=2, color='red')
-    ax2.bar(data.index, data['MACD_Histogram'], label='Histogram', 
-            color=['green' if x > 0 else 'red' for x in data['MACD_Histogram']], 
-            alpha=0.5)
-    ax2.axhline(y=0, color='black', linestyle='--', linewidth=1)
-    ax2.scatter(data.index[-1], data['MACD'].iloc[-1], 
-                color='red', s=200, zorder=5, label='第一根紅K')
-    ax2.set_title('月MACD指標（第一根紅K）')
-    ax2.set_xlabel('日期')
-    ax2.set_ylabel('MACD')
-    ax2.legend(loc='best')
-    ax2.grid(True, alpha=0.3)
-    
-    # 子圖3：月KD指標
-    ax3.plot(data.index, data['K'], label='K', linewidth=2, color='blue')
-    ax3.plot(data.index, data['D'], label='D', linewidth=2, color='red')
-    ax3.axhline(y=80, color='red', linestyle='--', alpha=0.5, label='超買(80)')
-    ax3.axhline(y=20, color='green', linestyle='--', alpha=0.5, label='超賣(20)')
-    ax3.fill_between(data.index, 0, 20, color='green', alpha=0.1)
-    ax3.fill_between(data.index, 80, 100, color='red', alpha=0.1)
-    ax3.set_title('月KD指標')
-    ax3.set_xlabel('日期')
-    ax3.set_ylabel('KD值')
-    ax3.set_ylim([0, 100])
-    ax3.legend(loc='best')
-    ax3.grid(True, alpha=0.3)
-    
-    # 子圖4：月RSI指標
-    ax4.plot(data.index, data['RSI'], label='RSI', linewidth=2, color='purple')
-    ax4.axhline(y=70, color='red', linestyle='--', alpha=0.5, label='超買(70)')
-    ax4.axhline(y=30, color='green', linestyle='--', alpha=0.5, label='超賣(30)')
-    ax4.fill_between(data.index, 0, 30, color='green', alpha=0.1)
-    ax4.fill_between(data.index, 70, 100, color='red', alpha=0.1)
-    ax4.set_title('月RSI指標')
-    ax4.set_xlabel('日期')
-    ax4.set_ylabel('RSI值')
-    ax4.set_ylim([0, 100])
-    ax4.legend(loc='best')
-    ax4.grid(True, alpha=0.3)
-    
-    plt.tight_layout()
-    return fig
 
+class SnapshotStore:
+    """預先計算的掃描快照（每次產生一個版本目錄，每個模式一個 CSV）
 
-def main():
-    st.title("🔍 台股月MACD第一根紅K掃描器（完整版）")
-    st.markdown("✨ 支援掃描所有上市櫃股票（約1900檔）")
-    st.markdown("---")
-    
-    # 側邊欄設定
-    with st.sidebar:
-        st.header("⚙️ 掃描設定")
-        
-        # 選擇掃描範圍
-        st.subheader("📊 掃描範圍")
-        scan_mode = st.radio(
-            "選擇掃描模式",
-            ["🚀 快速模式（約70檔精選股）", "🔍 完整模式（全部上市櫃）"],
+    目錄結構：
+        <root>/<版本>/<模式>.csv
+        <root>/<版本>/manifest.json
+        <root>/LATEST            （最新完成版本的名稱）
+    LATEST 在所有檔案寫完後才以原子方式更新，讀取端不會讀到寫到一半的版本。
+    """
+
+    def __init__(self, root=SNAPSHOT_DIR):
+        self.root = root
+
+    def save(self, tables, meta=None, publish=True, universe=None):
+        """寫入一個新版本，tables = {模式: DataFrame}，回傳版本名稱
+
+        publish=False 時只保存（供日後比較），不更新 LATEST，開啟頁面時仍載入排程產生的快照
+        universe 為實際掃描過的股票代號，寫進 manifest，比較時只看兩次都掃描過的股票。
+        寫入後依保留份數清除舊版本。
+        """
+        version = datetime.now().strftime('%Y%m%d_%H%M%S')
+        version_dir = os.path.join(self.root, version)
+        os.makedirs(version_dir, exist_ok=True)
+
+        for mode_key, df in tables.items():
+            df.to_csv(os.path.join(version_dir, f'{mode_key}.csv'), index=False, encoding='utf-8-sig')
+
+        manifest = dict(meta or {})
+        manifest.update({
+            'version': version,
+            'published': publish,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'modes': {mode_key: len(df) for mode_key, df in tables.items()},
+        })
+        if universe is not None:
+            manifest['universe'] = sorted({code.replace('.TWO', '').replace('.TW', '') for code in universe})
+        with open(os.path.join(version_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        if publish:
+            tmp_path = os.path.join(self.root, 'LATEST.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(version)
+            os.replace(tmp_path, os.path.join(self.root, 'LATEST'))
+
+        self.prune()
+        return version
+
+    def prune(self, keep_live=SNAPSHOT_KEEP_LIVE, keep_published=SNAPSHOT_KEEP_PUBLISHED):
+        """刪除超過保留份數的舊版本；LATEST 與各模式目前載入的版本一律保留"""
+        protected = {self.latest_version()} | {self.latest_version(mode_key) for mode_key in SCAN_MODES}
+        live, published = [], []
+        for version in self.list_versions():
+            manifest = self.load_manifest(version) or {}
+            if manifest.get('published', manifest.get('source') != 'live'):
+                published.append(version)
+            else:
+                live.append(version)
+        for version in live[keep_live:] + published[keep_published:]:
+            if version not in protected:
+                shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+
+    def list_versions(self):
+        """列出所有已完成的版本（新到舊）"""
+        if not os.path.isdir(self.root):
+            return []
+        versions = [
+            name for name in os.listdir(self.root)
+            if os.path.isfile(os.path.join(self.root, name, 'manifest.json'))
+        ]
+        return sorted(versions, reverse=True)
+
+    def latest_version(self, mode_key=None):
+        """最新發布的版本；指定 mode_key 時，LATEST 沒有該模式就往前找最近一個有該模式的發布版本"""
+        try:
+            with open(os.path.join(self.root, 'LATEST'), encoding='utf-8') as f:
+                latest = f.read().strip() or None
+        except OSError:
+            return None
+        if latest is None or mode_key is None:
+            return latest
+
+        for version in self.list_versions():
+            if version > latest:
+                continue
+            manifest = self.load_manifest(version) or {}
+            published = manifest.get('published', manifest.get('source') != 'live')
+            if (version == latest or published) and mode_key in manifest.get('modes', {}):
+                return version
+        return None
+
+    def load_manifest(self, version):
+        try:
+            with open(os.path.join(self.root, version, 'manifest.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def universe(self, version):
+        """該版本實際掃描過的股票代號（不含 .TW/.TWO）；舊版本沒有記錄時回傳 None"""
+        codes = (self.load_manifest(version) or {}).get('universe')
+        return None if codes is None else set(codes)
+
+    def load(self, version, mode_key):
+        """讀取指定版本、模式的結果表，不存在回傳 None"""
+        path = os.path.join(self.root, version, f'{mode_key}.csv')
+        if not os.path.isfile(path):
+            return None
+        try:
+            return read_result_csv(path)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+    def load_tables(self, version):
+        """讀取指定版本所有模式的結果表 {模式: DataFrame}"""
+        tables = {}
+        for mode_key in SCAN_MODES:
+            df = self.load(version, mode_key)
+            if df is not None:
+                tables[mode_key] = df
+        return tables
+
+
+def diff_snapshots(current_tables, prior_tables, mode_key, universe_codes=None, prior_universe_codes=None):
+    """比較本次與前次快照（以股票代號合併），標示每檔股票的變化
+
+    current_tables / prior_tables 為 {模式: DataFrame}；只需讀取前次快照檔，不會重新抓資料。
+    「升級」指前次是綠柱縮短、本次出現第一根紅柱。universe_codes / prior_universe_codes
+    （不含 .TW/.TWO）為兩次各自掃描過的股票，只比較兩次都掃描過的股票，
+    避免快速模式與完整模式互比時，把範圍外的股票誤判為新增或消失。
+    """
+    columns = ['股票代號', '股票名稱', '訊號強度']
+
+    def table(tables, key):
+        df = tables.get(key)
+        return pd.DataFrame(columns=columns) if df is None or df.empty else df
+
+    current = table(current_tables, mode_key)
+    prior = table(prior_tables, mode_key)
+    if universe_codes is not None:
+        prior = prior[prior['股票代號'].isin(universe_codes)]
+    if prior_universe_codes is not None:
+        current = current[current['股票代號'].isin(prior_universe_codes)]
+
+    merged = current[columns].merge(
+        prior[columns], on='股票代號', how='outer', suffixes=('', '_前次'), indicator=True
+    )
+    merged['股票名稱'] = merged['股票名稱'].fillna(merged['股票名稱_前次'])
+    merged['強度變化'] = merged['訊號強度'] - merged['訊號強度_前次']
+
+    # 升級：前次綠柱縮短 → 本次第一根紅柱
+    if SIGNAL_TYPES[mode_key] == '第一根紅柱':
+        green_codes = table(prior_tables, 'green_shrink')['股票代號']
+        upgraded = (merged['_merge'] == 'left_only') & merged['股票代號'].isin(green_codes)
+    else:
+        red_codes = table(current_tables, 'first_red')['股票代號']
+        upgraded = (merged['_merge'] == 'right_only') & merged['股票代號'].isin(red_codes)
+
+    merged['變化'] = np.select(
+        [
+            upgraded,
+            merged['_merge'] == 'left_only',
+            merged['_merge'] == 'right_only',
+            merged['強度變化'] > 0,
+            merged['強度變化'] < 0,
+        ],
+        ['⬆️ 升級（綠柱縮短→第一根紅柱）', '🆕 新增', '❌ 消失', '📈 強度增加', '📉 強度減少'],
+        default='➖ 持續',
+    )
+    merged = merged.rename(columns={'訊號強度': '本次訊號強度', '訊號強度_前次': '前次訊號強度'})
+    return merged[['股票代號', '股票名稱', '變化', '前次訊號強度', '本次訊號強度', '強度變化']].sort_values(
+        ['變化', '股票代號'], ignore_index=True
+    )
+
+
+def run_precompute(stock_dict=None, store=None):
+    """一次掃描全市場，同時產生三種模式的快照（每檔股票月線只抓一次）"""
+    store = store or SnapshotStore()
+    if stock_dict is None:
+        stock_dict = StockListFetcher.get_all_tw_stocks()
+
+    industry_map = StockListFetcher.get_industry_map()
+    first_red, green_shrink = [], []
+    start_time = datetime.now()
+    total = len(stock_dict)
+
+    for idx, (stock_code, stock_name) in enumerate(stock_dict.items(), 1):
+        # 兩種判斷共用同一份快取的月線與股利資料；每日排程用增量模式，已收盤月線一個月只抓一次
+        industry = industry_map.get(stock_code, 'N/A')
+        result = analyze_stock(stock_code, stock_name or stock_code, incremental=True, industry=industry)
+        if result is not None:
+            first_red.append(result)
+        result = analyze_stock(stock_code, stock_name or stock_code, filter_green_shrink=True,
+                               incremental=True, industry=industry)
+        if result is not None:
+            green_shrink.append(result)
+
+        if idx % 100 == 0 or idx == total:
+            print(f'[precompute] {idx}/{total}  第一根紅柱 {len(first_red)} 檔  綠柱縮短 {len(green_shrink)} 檔', flush=True)
+
+    first_red_df = pd.DataFrame(first_red)
+    if first_red_df.empty:
+        macd_positive_df = first_red_df
+    else:
+        macd_positive_df = first_red_df[first_red_df['MACD位階'] == '多頭']
+
+    tables = {
+        'first_red': first_red_df,
+        'macd_positive': macd_positive_df,
+        'green_shrink': pd.DataFrame(green_shrink),
+    }
+    get_histogram_state().save()
+    elapsed_time = (datetime.now() - start_time).total_seconds()
+    version = store.save(tables, meta={'scanned': total, 'elapsed_seconds': round(elapsed_time, 1)},
+                         universe=stock_dict.keys())
+    print(f'[precompute] 快照 {version} 完成，耗時 {elapsed_time/60:.1f} 分鐘', flush=True)
+    return version
+
+
+def next_precompute_time(now, run_at=PRECOMPUTE_RUN_AT):
+    """下一個收盤後的排程時間（週一到週五）"""
+    hour, minute = (int(x) for x in run_at.split(':'))
+    candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= now:
+        candidate += timedelta(days=1)
+    while candidate.weekday() >= 5:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+def run_precompute_daemon(run_at=PRECOMPUTE_RUN_AT, once=False, quick=False):
+    """背景排程：每個交易日收盤後跑一次全市場掃描並發布快照"""
+    store = SnapshotStore()
+    while True:
+        if not once:
+            next_run = next_precompute_time(datetime.now(), run_at)
+            print(f'[precompute] 下次執行時間 {next_run:%Y-%m-%d %H:%M}', flush=True)
+            time.sleep(max(0, (next_run - datetime.now()).total_seconds()))
+
+        stock_dict = StockListFetcher.get_preset_stocks() if quick else None
+        try:
+            run_precompute(stock_dict, store)
+        except Exception as e:
+            print(f'[precompute] 掃描失敗: {str(e)[:200]}', flush=True)
+
+        if once:
+            return
+
+
+def shard_universe(stock_dict, n_shards, by='hash'):
+    """把股票清單切成固定的分片，回傳 [{代號: 名稱}, ...]
+
+    by='hash'：依代號的 CRC32 取餘數，同一檔股票永遠落在同一個分片（不受 Python hash 隨機化影響）
+    by='market'：上市、上櫃各一個分片（忽略 n_shards）
+    """
+    if by == 'market':
+        shards = [
+            {code: name for code, name in stock_dict.items() if code.endswith('.TW')},
+            {code: name for code, name in stock_dict.items() if code.endswith('.TWO')},
+        ]
+        return [shard for shard in shards if shard]
+
+    if by != 'hash':
+        raise ValueError(f"不支援的分片方式: {by}")
+    shards = [{} for _ in range(max(1, n_shards))]
+    for code in sorted(stock_dict):
+        shards[zlib.crc32(code.encode('utf-8')) % len(shards)][code] = stock_dict[code]
+    return [shard for shard in shards if shard]
+
+
+class ShardJobQueue:
+    """檔案式工作佇列：不需要訊息佇列服務，只要各 worker 看得到同一個目錄（本機或網路磁碟）
+
+    目錄結構：
+        <root>/pending/<job>.json    待處理
+        <root>/running/<job>.json    已被某個 worker 領走（以 os.rename 原子搬移，避免重複領取）
+        <root>/done/<job>.json       已完成
+        <root>/results/<job>.csv     各分片的部分結果（寫完才從 .partial 改名）
+        <root>/merged.csv            合併後的最終排序結果
+    """
+
+    def __init__(self, root):
+        self.root = root
+        for sub in ('pending', 'running', 'done', 'results'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    def _path(self, state, job_id, ext='json'):
+        sub = 'results' if ext == 'csv' else state
+        return os.path.join(self.root, sub, f'{job_id}.{ext}')
+
+    def plan(self, stock_dict, n_shards, mode_key='first_red', by='hash', incremental=False,
+             industry_map=None):
+        """切分股票清單並寫入待處理工作，回傳工作數
+
+        產業在規劃時一併寫進工作內容，其他機器上的 worker 不必再下載股票清單
+        """
+        if mode_key not in SCAN_MODES:
+            raise ValueError(f"不支援的掃描模式: {mode_key}")
+        if any(os.listdir(os.path.join(self.root, sub)) for sub in ('pending', 'running', 'done', 'results')):
+            raise ValueError(f"佇列目錄 {self.root} 已有工作或結果，請使用新的目錄")
+        shards = shard_universe(stock_dict, n_shards, by)
+        if industry_map is None:
+            industry_map = StockListFetcher.get_industry_map()
+        for idx, shard in enumerate(shards):
+            job = {
+                'job_id': f'shard_{idx:03d}',
+                'mode': mode_key,
+                'incremental': incremental,
+                'stocks': shard,
+                'industries': {code: industry_map.get(code, 'N/A') for code in shard},
+            }
+            tmp_path = self._path('pending', job['job_id'], 'tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path('pending', job['job_id']))
+        return len(shards)
+
+    def claim(self):
+        """領取一個待處理工作，沒有工作時回傳 None"""
+        for name in sorted(os.listdir(os.path.join(self.root, 'pending'))):
+            if not name.endswith('.json'):
+                continue
+            job_id = name[:-len('.json')]
+            running_path = self._path('running', job_id)
+            try:
+                os.rename(self._path('pending', job_id), running_path)
+            except OSError:
+                continue  # 被其他 worker 搶先領走
+            os.utime(running_path)
+            with open(running_path, encoding='utf-8') as f:
+                return json.load(f)
+        return None
+
+    def complete(self, job_id):
+        """標記工作完成；若工作在執行中被 requeue_stale 放回佇列，直接從待處理移到完成"""
+        try:
+            os.replace(self._path('running', job_id), self._path('done', job_id))
+        except FileNotFoundError:
+            try:
+                os.replace(self._path('pending', job_id), self._path('done', job_id))
+            except FileNotFoundError:
+                pass  # 已被其他 worker 重新領走，由對方標記完成
+
+    def result_path(self, job_id):
+        return self._path('results', job_id, 'csv')
+
+    def requeue_stale(self, max_age=SHARD_STALE_SECONDS):
+        """把執行過久（worker 可能已中斷）的工作放回待處理，回傳重新排入的數量"""
+        count = 0
+        now = time.time()
+        for name in os.listdir(os.path.join(self.root, 'running')):
+            path = os.path.join(self.root, 'running', name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.rename(path, os.path.join(self.root, 'pending', name))
+                    count += 1
+            except OSError:
+                continue
+        return count
+
+    def status(self):
+        """{'pending': n, 'running': n, 'done': n}"""
+        return {
+            state: len([n for n in os.listdir(os.path.join(self.root, state)) if n.endswith('.json')])
+            for state in ('pending', 'running', 'done')
+        }
+
+    def jobs(self, state='done'):
+        """讀取某個狀態下的所有工作內容"""
+        jobs = []
+        for name in sorted(os.listdir(os.path.join(self.root, state))):
+            if name.endswith('.json'):
+                with open(os.path.join(self.root, state, name), encoding='utf-8') as f:
+                    jobs.append(json.load(f))
+        return jobs
+
+    def merge(self):
+        """合併所有已完成分片的部分結果，依訊號強度與交叉力道 / 縮短幅度排序並寫出 merged.csv"""
+        results_dir = os.path.join(self.root, 'results')
+        frames = []
+        for name in sorted(os.listdir(results_dir)):
+            if not name.endswith('.csv'):
+                continue
+            try:
+                frames.append(read_result_csv(os.path.join(results_dir, name)))
+            except pd.errors.EmptyDataError:
+                continue  # 該分片沒有命中
+
+        merged = sort_results(pd.concat(frames, ignore_index=True)) if frames else pd.DataFrame()
+        merged.to_csv(os.path.join(self.root, 'merged.csv'), index=False, encoding='utf-8-sig')
+        return merged
+
+
+def run_shard_worker(queue_root, worker_id=None):
+    """持續領取並處理分片工作，直到佇列清空；回傳處理的工作數"""
+    queue = ShardJobQueue(queue_root)
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    processed = 0
+
+    while True:
+        job = queue.claim()
+        if job is None:
+            return processed
+
+        mode_key = job['mode']
+        stock_dict = job['stocks']
+        print(f'[{worker_id}] 開始 {job["job_id"]}（{len(stock_dict)} 檔，{SCAN_MODES[mode_key]}）', flush=True)
+
+        # 先寫 .partial（檔名含 worker，重新排入的工作被兩個 worker 同時處理也不會互相寫壞），
+        # 完成後才改名，合併時不會讀到寫到一半的檔案
+        result_path = queue.result_path(job['job_id'])
+        partial_path = f'{result_path}.{worker_id}.partial'
+        with StreamingResultSink(partial_path, fmt='csv') as sink:
+            scan_all_stocks(
+                stock_dict, None, None, None,
+                filter_macd_positive=(mode_key == 'macd_positive'),
+                filter_green_shrink=(mode_key == 'green_shrink'),
+                min_green_shrink_pct=0.0,
+                incremental=job.get('incremental', False),
+                sink=sink,
+                industry_map=job.get('industries', {}),
+            )
+        os.replace(partial_path, result_path)
+        queue.complete(job['job_id'])
+        processed += 1
+        print(f'[{worker_id}] 完成 {job["job_id"]}，命中 {sink.count} 檔', flush=True)
+
+
+def run_local_shards(stock_dict, n_workers, queue_root, mode_key='first_red', by='hash',
+                     n_shards=None, incremental=False):
+    """在本機以多個程序平行處理所有分片後合併結果（分片數預設為 worker 數的 4 倍，讓快的程序多做）"""
+    queue = ShardJobQueue(queue_root)
+    queue.plan(stock_dict, n_shards or n_workers * 4, mode_key=mode_key, by=by, incremental=incremental)
+
+    workers = [
+        multiprocessing.Process(target=run_shard_worker, args=(queue_root, f'local-{idx}'))
+        for idx in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    status = queue.status()
+    if status['pending'] or status['running']:
+        print(f'[shard] 尚有未完成的分片: {status}', flush=True)
+    return queue.merge()
+
+
+class IndicatorPanel:
+    """全市場月線面板（月份 × 股票），指標以 numpy 一次算完所有股票"""
+
+    @staticmethod
+    def build(stock_codes, period=SWEEP_PERIOD, progress_callback=None):
+        """從（快取的）月線組出 {'Close'/'High'/'Low': DataFrame(月份 × 代號)}"""
+        columns = {'Close': {}, 'High': {}, 'Low': {}}
+        total = len(stock_codes)
+
+        for idx, stock_code in enumerate(stock_codes, 1):
+            if progress_callback is not None:
+                progress_callback(idx, total, stock_code)
+            data = StockScanner.fetch_monthly_data(stock_code, period)
+            if data is None:
+                continue
+            # 以月份對齊各股票（Yahoo 偶爾會多給一筆當月的日期）
+            data.index = pd.PeriodIndex(data.index.strftime('%Y-%m'), freq='M')
+            data = data[~data.index.duplicated(keep='last')]
+            for col in columns:
+                columns[col][stock_code] = data[col]
+
+        return {col: pd.DataFrame(series).sort_index() for col, series in columns.items()}
+
+    @staticmethod
+    def ema_stack(values, spans, initial=None):
+        """一次計算多個週期的 EMA（adjust=False），values 形狀 (..., 月份, 股票)
+
+        回傳形狀 (len(spans), ..., 月份, 股票)。只在時間軸上迴圈，所有週期與股票同時向量化計算；
+        開頭的 NaN 保持 NaN，中間缺值沿用前一期數值。
+        initial 為上一期的 EMA（形狀 (len(spans), ..., 股票)），用於接續先前的計算結果。
+        """
+        values = np.asarray(values, dtype=float)
+        alphas = 2.0 / (np.asarray(spans, dtype=float) + 1.0)
+        alphas = alphas.reshape((-1,) + (1,) * (values.ndim - 1))  # 對時間軸切片廣播
+
+        out = np.full((len(spans),) + values.shape, np.nan)
+        prev = np.full((len(spans),) + values[..., 0, :].shape, np.nan)
+        if initial is not None:
+            prev = np.broadcast_to(np.asarray(initial, dtype=float), prev.shape).copy()
+        for t in range(values.shape[-2]):
+            x = values[..., t, :]
+            new = np.where(np.isnan(prev), x, alphas * x + (1 - alphas) * prev)
+            prev = np.where(np.isnan(x), prev, new)
+            out[..., t, :] = prev
+        return out
+
+    @staticmethod
+    def kd(panel, period=9, k_period=3, d_period=3):
+        """全市場月KD，回傳 (K, D) 兩個 (月份, 股票) 陣列"""
+        low_min = panel['Low'].rolling(window=period).min()
+        high_max = panel['High'].rolling(window=period).max()
+        rsv = (100 * (panel['Close'] - low_min) / (high_max - low_min)).to_numpy()
+        k = IndicatorPanel.ema_stack(rsv, [k_period])[0]
+        d = IndicatorPanel.ema_stack(k, [d_period])[0]
+        return k, d
+
+    @staticmethod
+    def rsi(panel, period=14):
+        """全市場月RSI，回傳 (月份, 股票) 陣列"""
+        delta = panel['Close'].diff()
+        gain = delta.where(delta > 0, 0).rolling(window=period).mean()
+        loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
+        return (100 - (100 / (1 + gain / loss))).to_numpy()
+
+
+class ParameterSweep:
+    """MACD / KD / RSI 參數掃描：一次算完整個參數網格的訊號數與後續報酬"""
+
+    @staticmethod
+    def run(panel, fast_spans=(12,), slow_spans=(26,), signal_spans=(9,),
+            kd_periods=(9,), rsi_periods=(14,), horizons=SWEEP_HORIZONS, warmup=12):
+        """回傳每組參數一列的 DataFrame
+
+        訊號定義與 check_first_macd_red 相同（MACD 由下往上穿越 Signal），
+        KD金叉（K>D）與 RSI偏低（<50）視為確認條件另外統計；前 warmup 個月 EMA 尚未穩定，不列入統計
+        （至少為最長的慢線週期）。只用已收盤的月份，尚未收盤的當月K棒不列入訊號與報酬。
+        """
+        completed_month = pd.Period(datetime.now(), freq='M') - 1
+        panel = {col: frame[frame.index <= completed_month] for col, frame in panel.items()}
+        warmup = max(warmup, max(slow_spans, default=0))
+        close = panel['Close']
+        prices = close.to_numpy(dtype=float)
+        n_months = prices.shape[0]
+        if n_months <= warmup + 1:
+            return pd.DataFrame()
+
+        # 所有快慢線週期一次算完
+        spans = sorted(set(fast_spans) | set(slow_spans))
+        emas = dict(zip(spans, IndicatorPanel.ema_stack(prices, spans)))
+
+        combos = [(f, sl) for f in fast_spans for sl in slow_spans if f < sl]
+        if not combos:
+            return pd.DataFrame()
+        macd = np.stack([emas[f] - emas[sl] for f, sl in combos])          # (組合, 月份, 股票)
+        signal_lines = IndicatorPanel.ema_stack(macd, list(signal_spans))  # (訊號週期, 組合, 月份, 股票)
+        above = macd[np.newaxis] > signal_lines
+        events = np.zeros_like(above)
+        events[..., 1:, :] = above[..., 1:, :] & ~above[..., :-1, :]
+        events[..., :warmup, :] = False
+
+        forward_returns = {
+            h: (close.shift(-h) / close - 1).to_numpy() * 100 for h in horizons
+        }
+        kd_confirm = {p: np.greater(*IndicatorPanel.kd(panel, period=p)) for p in kd_periods}
+        rsi_confirm = {p: IndicatorPanel.rsi(panel, period=p) < 50 for p in rsi_periods}
+        main_horizon = horizons[len(horizons) // 2]
+
+        rows = []
+        for s_idx, signal_span in enumerate(signal_spans):
+            for c_idx, (fast, slow) in enumerate(combos):
+                mask = events[s_idx, c_idx]
+                base = {
+                    '快線': fast, '慢線': slow, '訊號線': signal_span,
+                    '訊號數': int(mask.sum()),
+                    '最新收盤月訊號數': int(mask[-1].sum()),
+                }
+                for h, fwd in forward_returns.items():
+                    base.update(ParameterSweep._return_stats(fwd, mask, f'{h}M'))
+
+                for kd_period in kd_periods:
+                    for rsi_period in rsi_periods:
+                        row = dict(base, KD週期=kd_period, RSI週期=rsi_period)
+                        kd_mask = mask & kd_confirm[kd_period]
+                        rsi_mask = mask & rsi_confirm[rsi_period]
+                        row['KD金叉確認數'] = int(kd_mask.sum())
+                        row.update(ParameterSweep._return_stats(
+                            forward_returns[main_horizon], kd_mask, f'{main_horizon}M(KD確認)'))
+                        row['RSI偏低確認數'] = int(rsi_mask.sum())
+                        row.update(ParameterSweep._return_stats(
+                            forward_returns[main_horizon], rsi_mask, f'{main_horizon}M(RSI確認)'))
+                        rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def _return_stats(forward_return, mask, label):
+        """事件發生後的報酬統計（尚無後續資料的事件不計）"""
+        values = forward_return[mask & ~np.isnan(forward_return)]
+        if len(values) == 0:
+            return {f'平均報酬{label}%': np.nan, f'中位數報酬{label}%': np.nan, f'勝率{label}%': np.nan}
+        return {
+            f'平均報酬{label}%': round(float(values.mean()), 2),
+            f'中位數報酬{label}%': round(float(np.median(values)), 2),
+            f'勝率{label}%': round(float((values > 0).mean() * 100), 1),
+        }
+
+
+class MarketBreadth:
+    """市場廣度：每個月全市場（及上市 / 上櫃）有多少比例的股票出現紅柱、第一根紅柱、綠柱縮短
+
+    計算結果與每檔股票最後一個已收盤月份的 EMA 狀態一起存檔，
+    新的月份到來時只需從存檔狀態往後遞推，不必從頭重算整段歷史。
+    """
+
+    METRICS = ['紅柱%', '第一根紅柱%', '綠柱縮短%']
+
+    def __init__(self, universe='full', period='5y', path=None, fast=12, slow=26, signal=9):
+        # 不同股票範圍、歷史長度各自存檔，快速模式的結果不會混進完整模式
+        self.path = path or BREADTH_STATE_PATH.format(universe=universe, period=period)
+        self.universe = universe
+        self.period = period
+        self.params = {'fast': fast, 'slow': slow, 'signal': signal}
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # 參數、股票範圍、歷史長度不同的存檔不能接續使用
+        if (state.get('params') != self.params or state.get('universe') != self.universe
+                or state.get('period') != self.period or not state.get('month')):
+            return None
+        return state
+
+    def save(self):
+        if self.state is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def series(self):
+        """已收盤月份的廣度序列（長格式：月份、市場、各指標%、股票數）"""
+        if not self.state or not self.state['series']:
+            return pd.DataFrame()
+        return pd.DataFrame(self.state['series']).sort_values(['月份', '市場'], ignore_index=True)
+
+    def update(self, panel):
+        """用面板資料更新廣度；回傳含當月暫定值的完整序列
+
+        已存檔的月份不重算；存檔之後才上市的股票，EMA 從第一筆收盤價開始累積。
+        面板中有存檔沒記錄、但在存檔月份以前就有資料的股票時（股票範圍擴大），
+        接續計算會讓這些股票的 EMA 從中途起算，因此改為從頭重算。
+        """
+        close = panel['Close']
+        codes = list(close.columns)
+        completed_month = pd.Period(datetime.now(), freq='M') - 1
+
+        # 存檔月份早於面板起點（中間有缺口）就無法接續，改為從頭計算
+        if self.state is not None:
+            state_month = pd.Period(self.state['month'], freq='M')
+            missing = [c for c in codes if c not in self.state['tickers']]
+            if close.empty or state_month < close.index[0] - 1:
+                self.state = None
+            elif missing and close.loc[close.index <= state_month, missing].notna().any().any():
+                self.state = None
+        if self.state is None:
+            self.state = {'params': self.params, 'universe': self.universe, 'period': self.period,
+                          'month': None, 'tickers': {}, 'series': []}
+            new_rows = close
+        else:
+            new_rows = close[close.index > pd.Period(self.state['month'], freq='M')]
+
+        if new_rows.empty:
+            return self.series()
+
+        # 上一期狀態：[ema_fast, ema_slow, signal, histogram]
+        prev = np.array([self.state['tickers'].get(c, [np.nan] * 4) for c in codes], dtype=float).reshape(-1, 4)
+        values = new_rows.to_numpy(dtype=float)
+
+        ema_fast = IndicatorPanel.ema_stack(values, [self.params['fast']], initial=prev[np.newaxis, :, 0])[0]
+        ema_slow = IndicatorPanel.ema_stack(values, [self.params['slow']], initial=prev[np.newaxis, :, 1])[0]
+        macd = ema_fast - ema_slow
+        signal_line = IndicatorPanel.ema_stack(macd, [self.params['signal']], initial=prev[np.newaxis, :, 2])[0]
+        histogram = macd - signal_line
+        prev_histogram = np.vstack([prev[np.newaxis, :, 3], histogram[:-1]])
+
+        rows = self._breadth_rows(new_rows.index, codes, histogram, prev_histogram)
+
+        # 只把已收盤的月份寫進狀態，當月暫定值每次重新計算
+        completed = np.asarray(new_rows.index <= completed_month)
+        if completed.any():
+            last = np.flatnonzero(completed)[-1]
+            self.state['month'] = str(new_rows.index[last])
+            tickers = dict(self.state['tickers'])
+            for i, code in enumerate(codes):
+                tickers[code] = [float(ema_fast[last, i]), float(ema_slow[last, i]),
+                                 float(signal_line[last, i]), float(histogram[last, i])]
+            self.state['tickers'] = tickers
+            done_months = {str(m) for m in new_rows.index[completed]}
+            self.state['series'] += [r for r in rows if r['月份'] in done_months]
+
+        provisional = [dict(r, 暫定=True) for r in rows if pd.Period(r['月份'], freq='M') > completed_month]
+        combined = pd.concat([self.series(), pd.DataFrame(provisional)], ignore_index=True)
+        if combined.empty:
+            return combined
+        return combined.sort_values(['月份', '市場'], ignore_index=True)
+
+    @staticmethod
+    def _breadth_rows(months, codes, histogram, prev_histogram):
+        """依市場分組，計算每個月各指標佔有效股票數的比例"""
+        is_twse = np.array([c.endswith('.TW') for c in codes])
+        groups = {'全市場': np.ones(len(codes), dtype=bool), '上市': is_twse, '上櫃': ~is_twse}
+
+        red = histogram > 0
+        first_red = red & (prev_histogram <= 0)
+        green_shrink = (histogram < 0) & (prev_histogram < 0) & (np.abs(histogram) < np.abs(prev_histogram))
+        valid = ~np.isnan(histogram)
+
+        rows = []
+        for market, mask in groups.items():
+            count = valid[:, mask].sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ratios = {
+                    '紅柱%': red[:, mask].sum(axis=1) / count * 100,
+                    '第一根紅柱%': first_red[:, mask].sum(axis=1) / count * 100,
+                    '綠柱縮短%': green_shrink[:, mask].sum(axis=1) / count * 100,
+                }
+            for t, month in enumerate(months):
+                if count[t] == 0:
+                    continue
+                row = {'月份': str(month), '市場': market, '股票數': int(count[t])}
+                row.update({name: round(float(v[t]), 2) for name, v in ratios.items()})
+                rows.append(row)
+        return rows
+
+
+def plot_monthly_chart(data, stock_code, stock_name):
+    """繪製月線圖表"""
+    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(16, 10))
+    
+    # 子圖1：月K線圖
+    ax1.plot(data.index, data['Close'], label='月收盤價', linewidth=2, color='black')
+    ax1.scatter(data.index[-1], data['Close'].iloc[-1], 
+                color='red', s=200, zorder=5, label='當前月份')
+    ax1.set_title(f'{stock_name} ({stock_code}) - 月K線圖')
+    ax1.set_xlabel('日期')
+    ax1.set_ylabel('價格 (元)')
+    ax1.legend(loc='best')
+    ax1.grid(True, alpha=0.3)
+    
+    # 子圖2：月MACD
+    ax2.plot(data.index, data['MACD'], label='MACD', linewidth=2, color='blue')
+    ax2.plot(data.index, data['MACD_Signal'], label='Signal', linewidth=2, color='red')
+    ax2.bar(data.index, data['MACD_Histogram'], label='Histogram', 
+            color=['green' if x > 0 else 'red' for x in data['MACD_Histogram']], 
+            alpha=0.5)
+    ax2.axhline(y=0, color='black', linestyle='--', linewidth=1)
+    ax2.scatter(data.index[-1], data['MACD'].iloc[-1], 
+                color='red', s=200, zorder=5, label='第一根紅K')
+    ax2.set_title('月MACD指標（第一根紅K）')
+    ax2.set_xlabel('日期')
+    ax2.set_ylabel('MACD')
+    ax2.legend(loc='best')
+    ax2.grid(True, alpha=0.3)
+    
+    # 子圖3：月KD指標
+    ax3.plot(data.index, data['K'], label='K', linewidth=2, color='blue')
+    ax3.plot(data.index, data['D'], label='D', linewidth=2, color='red')
+    ax3.axhline(y=80, color='red', linestyle='--', alpha=0.5, label='超買(80)')
+    ax3.axhline(y=20, color='green', linestyle='--', alpha=0.5, label='超賣(20)')
+    ax3.fill_between(data.index, 0, 20, color='green', alpha=0.1)
+    ax3.fill_between(data.index, 80, 100, color='red', alpha=0.1)
+    ax3.set_title('月KD指標')
+    ax3.set_xlabel('日期')
+    ax3.set_ylabel('KD值')
+    ax3.set_ylim([0, 100])
+    ax3.legend(loc='best')
+    ax3.grid(True, alpha=0.3)
+    
+    # 子圖4：月RSI指標
+    ax4.plot(data.index, data['RSI'], label='RSI', linewidth=2, color='purple')
+    ax4.axhline(y=70, color='red', linestyle='--', alpha=0.5, label='超買(70)')
+    ax4.axhline(y=30, color='green', linestyle='--', alpha=0.5, label='超賣(30)')
+    ax4.fill_between(data.index, 0, 30, color='green', alpha=0.1)
+    ax4.fill_between(data.index, 70, 100, color='red', alpha=0.1)
+    ax4.set_title('月RSI指標')
+    ax4.set_xlabel('日期')
+    ax4.set_ylabel('RSI值')
+    ax4.set_ylim([0, 100])
+    ax4.legend(loc='best')
+    ax4.grid(True, alpha=0.3)
+    
+    plt.tight_layout()
+    return fig
+
+
+def main():
+    st.title("🔍 台股月MACD第一根紅K掃描器（完整版）")
+    st.markdown("✨ 支援掃描所有上市櫃股票（約1900檔）")
+    st.markdown("---")
+    
+    with st.sidebar:
+        page = st.radio("🧭 功能", ["📡 訊號掃描", "📊 市場廣度", "🧪 參數掃描"], horizontal=True)
+        st.markdown("---")
+    
+    if page == "🧪 參數掃描":
+        render_parameter_sweep_page()
+        return
+    if page == "📊 市場廣度":
+        render_market_breadth_page()
+        return
+    
+    # 側邊欄設定
+    with st.sidebar:
+        st.header("⚙️ 掃描設定")
+        
+        # 選擇掃描範圍
+        st.subheader("📊 掃描範圍")
+        scan_mode = st.radio(
+            "選擇掃描模式",
+            ["🚀 快速模式（約70檔精選股）", "🔍 完整模式（全部上市櫃）"],
             index=1,  # 預設選完整模式
             help="快速模式：3-5分鐘 | 完整模式：30-60分鐘"
         )
         
+        # 產業篩選（優先用已快取的股票清單；沒有快取時每個 session 只嘗試下載一次）
+        selected_industries = []
+        if st.checkbox("🏭 限定產業", value=False, help="掃描前先依證交所產業別縮小範圍，未選產業的股票不會下載股價"):
+            universe = StockListFetcher.get_cached_universe()
+            if universe.empty and not st.session_state.get('industry_universe_tried'):
+                st.session_state['industry_universe_tried'] = True
+                universe = StockListFetcher.get_universe()
+            if universe.empty:
+                st.caption("⚠️ 無法取得產業清單，請稍後再試")
+            industry_options = sorted(universe['產業'].unique()) if not universe.empty else []
+            selected_industries = st.multiselect("選擇產業", industry_options)
+        
         st.markdown("---")
         
         # 篩選條件
@@ -532,7 +1973,7 @@ def main():
         
         macd_scan_mode = st.radio(
             "📡 掃描訊號模式",
-            ["🔴 第一根紅柱", "📈 MACD>0（多頭）", "🟢 綠柱縮短（預警）"],
+            list(SCAN_MODES.values()),
             index=0,
             help="🔴第一根紅柱：柱狀體從負轉正 | 📈MACD>0：限多頭位階的第一根紅柱 | 🟢綠柱縮短：空方動能減弱的預警，比紅柱早一個月"
         )
@@ -589,8 +2030,55 @@ def main():
         else:
             st.info("🔴 第一根紅柱：柱狀體從負轉正，不限MACD位階")
         
+        incremental = st.checkbox(
+            "📅 月中增量模式",
+            value=False,
+            help="已收盤月線使用快取，只抓當月日線重建本月K棒，適合每日盯盤；結果的「月線狀態」會標示暫定或確認"
+        )
+        
+        st.markdown("---")
+        
+        export_format = st.selectbox(
+            "💾 掃描時即時匯出",
+            ["不匯出", "CSV", "JSONL", "Parquet"],
+            index=0,
+            help=f"每找到一檔就寫入 {EXPORT_DIR}/ 下的檔案，掃描途中即可用其他工具讀取（Parquet 需安裝 pyarrow，掃描結束後才可讀）"
+        )
+        
+        st.markdown("---")
+        
+        st.subheader("⚡ 優先掃描")
+        prioritize = st.checkbox(
+            "依上次柱狀體優先掃描",
+            value=True,
+            help="用上次掃描記錄的月MACD柱狀體排序，綠柱縮短、接近翻紅的股票先掃，命中的股票會較早出現"
+        )
+        max_results = st.number_input(
+            "找到幾檔後停止（0=不限）",
+            min_value=0,
+            max_value=500,
+            value=0,
+            step=10,
+        )
+        time_budget_min = st.number_input(
+            "掃描時間上限（分鐘，0=不限）",
+            min_value=0,
+            max_value=120,
+            value=0,
+            step=5,
+        )
+        
+        st.markdown("---")
+        
+        use_snapshot = st.checkbox(
+            "📦 開啟時載入最新快照",
+            value=True,
+            help="直接顯示背景排程（python stock_macd2.py precompute）收盤後產生的全市場結果，按下開始掃描才即時重新掃描"
+        )
+        
         # 開始掃描按鈕
         start_scan = st.button("🚀 開始掃描", type="primary", use_container_width=True)
+        st.caption(f"🗄️ 共用快取：{len(get_shared_cache())} 筆（所有使用者共享，重複掃描不會重新下載）")
     
     # 主要內容區
     if start_scan:
@@ -606,6 +2094,13 @@ def main():
             st.error("❌ 無法取得股票清單，請檢查網路連線")
             return
         
+        if selected_industries:
+            stock_dict = StockListFetcher.filter_by_industry(stock_dict, selected_industries)
+            st.info(f"🏭 限定產業：{', '.join(selected_industries)}，剩 {len(stock_dict)} 檔")
+            if not stock_dict:
+                st.warning("⚠️ 所選產業沒有可掃描的股票")
+                return
+        
         # 進度條
         progress_bar = st.progress(0)
         status_text = st.empty()
@@ -614,274 +2109,781 @@ def main():
         st.markdown(f"### 🔍 掃描中...（{macd_scan_mode} 模式，即時結果）")
         result_container = st.container()
         
+        # 即時匯出檔
+        export_sink = None
+        if export_format != "不匯出":
+            export_path = os.path.join(
+                EXPORT_DIR,
+                f"monthly_macd_scan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format.lower()}"
+            )
+            try:
+                export_sink = StreamingResultSink(export_path)
+                st.caption(f"💾 掃描結果即時寫入 {export_path}")
+            except ImportError:
+                st.warning("⚠️ 未安裝 pyarrow，無法匯出 Parquet，本次不即時匯出")
+        
         # 執行掃描
+        mode_key = SNAPSHOT_MODE_KEYS[macd_scan_mode]
+        first_red_results = [] if filter_green_shrink else None
+        all_results = []
         start_time = datetime.now()
-        results = scan_all_stocks(
-            stock_dict, progress_bar, status_text, result_container,
-            filter_macd_positive=filter_macd_positive,
-            filter_green_shrink=filter_green_shrink,
-            filter_has_dividend=filter_has_dividend,
-            min_dividend_yield=min_dividend_yield,
-            min_signal_strength=min_signal_strength,
-            min_green_shrink_pct=min_green_shrink_pct,
-        )
+        try:
+            results, scanned = scan_all_stocks(
+                stock_dict, progress_bar, status_text, result_container,
+                filter_macd_positive=filter_macd_positive,
+                filter_green_shrink=filter_green_shrink,
+                filter_has_dividend=filter_has_dividend,
+                min_dividend_yield=min_dividend_yield,
+                min_signal_strength=min_signal_strength,
+                min_green_shrink_pct=min_green_shrink_pct,
+                prioritize=prioritize,
+                max_results=int(max_results),
+                time_budget=time_budget_min * 60,
+                incremental=incremental,
+                sink=export_sink,
+                first_red_results=first_red_results,
+                # 完整模式剛載入過股票清單；快速模式沒有清單時產業標為 N/A，不另外連線
+                industry_map=StockListFetcher.get_industry_map(download=False),
+                all_results=all_results,
+            )
+        finally:
+            if export_sink is not None:
+                export_sink.close()
         elapsed_time = (datetime.now() - start_time).total_seconds()
         
         # 清除進度顯示
         progress_bar.empty()
         status_text.empty()
         
+        partial = len(scanned) < len(stock_dict)
+        if partial:
+            st.info(f"⏹️ 已依設定提前停止，實際掃描 {len(scanned)}/{len(stock_dict)} 檔")
+        
         if not results:
+            st.session_state.pop('live_scan', None)
             st.warning("⚠️ 目前沒有找到符合條件的股票")
             st.info(f"⏱️ 掃描完成，耗時 {elapsed_time:.1f} 秒")
             return
         
-        # 轉換為DataFrame
-        df = pd.DataFrame(results)
-        
-        # 套用篩選條件
-        original_count = len(df)
-        
-        if filter_macd_positive:
-            df = df[df['MACD位階'] == '多頭']
-        
-        if filter_has_dividend:
-            df = df[df['有發股利'] == '✓']
-        
-        if min_dividend_yield > 0:
-            df = df[df['殖利率'] >= min_dividend_yield]
-        
-        if min_signal_strength > 0:
-            df = df[df['訊號強度'] >= min_signal_strength]
-        
-        if filter_green_shrink and '縮短比例%' in df.columns and min_green_shrink_pct > 0:
-            df = df[df['縮短比例%'] >= min_green_shrink_pct]
-        
-        filtered_count = len(df)
-        
-        # 依訊號強度和交叉力道排序
-        # 綠柱縮短模式用「縮短幅度」排序，其他模式用「交叉力道」排序
-        if '交叉力道' in df.columns:
-            df = df.sort_values(['訊號強度', '交叉力道'], ascending=[False, False])
-        elif '縮短幅度' in df.columns:
-            df = df.sort_values(['訊號強度', '縮短幅度'], ascending=[False, False])
-        else:
-            df = df.sort_values(['訊號強度'], ascending=[False])
-        
+        # 保存未套用篩選條件的命中結果（與排程快照同口徑），畫面上再依側邊欄條件篩選，
+        # 之後不論用哪一組條件比較，兩邊都套用同一組條件
+        df = pd.DataFrame(all_results)
+        current_tables = {mode_key: df}
+        if first_red_results is not None:
+            current_tables['first_red'] = pd.DataFrame(first_red_results)
+        # 保存本次結果供日後比較（不取代排程快照成為開啟頁面時的預設）；
+        # 提前停止的掃描標記為 partial，不會被列為比較對象
+        live_version = SnapshotStore().save(
+            current_tables,
+            meta={'source': 'live', 'scanned': len(scanned), 'partial': partial},
+            publish=False,
+            universe=scanned,
+        )
+        # 存進 session_state，之後操作其他元件（選股票、選比較快照）重跑時仍顯示這次結果
+        st.session_state['live_scan'] = {
+            'mode_key': mode_key,
+            'df': df,
+            'scanned_count': len(scanned),
+            'universe_codes': {code.replace('.TWO', '').replace('.TW', '') for code in scanned},
+            'current_tables': current_tables,
+            'live_version': live_version,
+            'elapsed_time': elapsed_time,
+            'export_sink': export_sink,
+        }
+    
+    live_scan = st.session_state.get('live_scan')
+    if live_scan is not None and live_scan['mode_key'] == SNAPSHOT_MODE_KEYS[macd_scan_mode]:
+        # 本 session 的即時掃描結果
+        df = live_scan['df']
+        scanned_count = live_scan['scanned_count']
+        universe_codes = live_scan['universe_codes']
+        current_tables = live_scan['current_tables']
+        live_version = live_scan['live_version']
+        elapsed_time = live_scan['elapsed_time']
+        export_sink = live_scan['export_sink']
+        mode_key = live_scan['mode_key']
+        snapshot_version = None
+    else:
+        export_sink = None
+        universe_codes = None
+        # 沒有即時掃描結果時，直接載入背景排程產生的最新快照
+        df, snapshot_version = None, None
+        if use_snapshot:
+            snapshot_store = SnapshotStore()
+            snapshot_version = snapshot_store.latest_version(SNAPSHOT_MODE_KEYS[macd_scan_mode])
+            if snapshot_version:
+                df = snapshot_store.load(snapshot_version, SNAPSHOT_MODE_KEYS[macd_scan_mode])
+        if df is None or df.empty:
+            render_welcome()
+            return
+        manifest = snapshot_store.load_manifest(snapshot_version) or {}
+        scanned_count = manifest.get('scanned', len(df))
+        elapsed_time = 0.0
+        mode_key = SNAPSHOT_MODE_KEYS[macd_scan_mode]
+        current_tables = snapshot_store.load_tables(snapshot_version)
+        universe_codes = snapshot_store.universe(snapshot_version)
+        live_version = None
+
+    render_scan_results(
+        df, scanned_count,
+        filter_macd_positive=filter_macd_positive,
+        filter_green_shrink=filter_green_shrink,
+        filter_has_dividend=filter_has_dividend,
+        min_dividend_yield=min_dividend_yield,
+        min_signal_strength=min_signal_strength,
+        min_green_shrink_pct=min_green_shrink_pct,
+        elapsed_time=elapsed_time,
+        snapshot_version=snapshot_version,
+        export_sink=export_sink,
+        industries=selected_industries,
+        mode_key=mode_key,
+        current_tables=current_tables,
+        universe_codes=universe_codes,
+        saved_version=live_version,
+    )
+
+
+def summarize_by_industry(df):
+    """依產業彙總：訊號數、平均訊號強度、平均殖利率（全部產業都是 N/A 時回傳空表）"""
+    if df.empty or '產業' not in df.columns or (df['產業'] == 'N/A').all():
+        return pd.DataFrame()
+    summary = df.groupby('產業').agg(
+        訊號數=('股票代號', 'size'),
+        平均訊號強度=('訊號強度', 'mean'),
+        平均殖利率=('殖利率', 'mean'),
+    )
+    return summary.round(2).sort_values(['訊號數', '平均訊號強度'], ascending=[False, False])
+
+
+def apply_result_filters(df, filter_macd_positive=False, filter_green_shrink=False,
+                         filter_has_dividend=False, min_dividend_yield=0.0, min_signal_strength=0,
+                         min_green_shrink_pct=0.0):
+    """套用側邊欄的篩選條件（與 scan_all_stocks 的即時篩選一致）"""
+    if df.empty:
+        return df
+    
+    if filter_macd_positive:
+        df = df[df['MACD位階'] == '多頭']
+    
+    if filter_has_dividend:
+        df = df[df['有發股利'] == '✓']
+    
+    if min_dividend_yield > 0:
+        df = df[df['殖利率'] >= min_dividend_yield]
+    
+    if min_signal_strength > 0:
+        df = df[df['訊號強度'] >= min_signal_strength]
+    
+    if filter_green_shrink and '縮短比例%' in df.columns and min_green_shrink_pct > 0:
+        df = df[df['縮短比例%'] >= min_green_shrink_pct]
+    
+    return df
+
+
+def sort_results(df):
+    """依訊號強度和交叉力道排序
+    
+    綠柱縮短模式用「縮短幅度」排序，其他模式用「交叉力道」排序
+    """
+    if df.empty:
+        return df
+    if '交叉力道' in df.columns:
+        return df.sort_values(['訊號強度', '交叉力道'], ascending=[False, False])
+    if '縮短幅度' in df.columns:
+        return df.sort_values(['訊號強度', '縮短幅度'], ascending=[False, False])
+    return df.sort_values(['訊號強度'], ascending=[False])
+
+
+def render_scan_results(df, scanned_count, filter_macd_positive=False, filter_green_shrink=False,
+                        filter_has_dividend=False, min_dividend_yield=0.0, min_signal_strength=0,
+                        min_green_shrink_pct=0.0, elapsed_time=0.0, snapshot_version=None,
+                        export_sink=None, industries=None, mode_key='first_red',
+                        current_tables=None, universe_codes=None, saved_version=None):
+    """顯示掃描結果（即時掃描或預先計算快照共用）"""
+    # 快照是全市場結果，限定產業時先縮小範圍
+    if industries and '產業' in df.columns:
+        df = df[df['產業'].isin(industries)]
+    
+    # 套用篩選條件
+    original_count = len(df)
+    filters = dict(
+        filter_macd_positive=filter_macd_positive,
+        filter_green_shrink=filter_green_shrink,
+        filter_has_dividend=filter_has_dividend,
+        min_dividend_yield=min_dividend_yield,
+        min_signal_strength=min_signal_strength,
+        min_green_shrink_pct=min_green_shrink_pct,
+    )
+    df = apply_result_filters(df, **filters)
+    filtered_count = len(df)
+    
+    df = sort_results(df)
+    
+    if snapshot_version:
+        st.success(f"📦 已載入預先計算快照 {snapshot_version}！找到 {original_count} 檔，篩選後剩 {filtered_count} 檔")
+        st.info("💡 快照由收盤後的背景排程產生，如需最新資料請按「🚀 開始掃描」即時重新掃描")
+    else:
         st.success(f"✅ 掃描完成！找到 {original_count} 檔，篩選後剩 {filtered_count} 檔")
         st.info(f"⏱️ 耗時 {elapsed_time:.1f} 秒 ({elapsed_time/60:.1f} 分鐘)")
-        
-        # 顯示統計摘要
-        st.markdown("---")
-        st.markdown("### 📊 掃描結果統計")
-        
-        col1, col2, col3, col4, col5 = st.columns(5)
-        
+    
+    # 顯示統計摘要
+    st.markdown("---")
+    st.markdown("### 📊 掃描結果統計")
+    
+    col1, col2, col3, col4, col5 = st.columns(5)
+    
+    with col1:
+        st.metric("掃描股票", f"{scanned_count} 檔")
+    
+    with col2:
+        st.metric("找到股票", f"{original_count} 檔")
+    
+    with col3:
+        st.metric("篩選後", f"{filtered_count} 檔")
+    
+    with col4:
+        strong_signals = len(df[df['訊號強度'] >= 2])
+        st.metric("強勢訊號", f"{strong_signals} 檔")
+    
+    with col5:
+        macd_positive = len(df[df['MACD位階'] == '多頭'])
+        st.metric("MACD多頭", f"{macd_positive} 檔")
+    
+    # 市場分布
+    if '市場' in df.columns:
+        st.markdown("#### 📈 市場分布")
+        col1, col2 = st.columns(2)
         with col1:
-            st.metric("掃描股票", f"{len(stock_dict)} 檔")
-        
+            twse_count = len(df[df['市場'] == '上市'])
+            st.metric("上市", f"{twse_count} 檔")
         with col2:
-            st.metric("找到股票", f"{original_count} 檔")
-        
-        with col3:
-            st.metric("篩選後", f"{filtered_count} 檔")
-        
-        with col4:
-            strong_signals = len(df[df['訊號強度'] >= 2])
-            st.metric("強勢訊號", f"{strong_signals} 檔")
-        
-        with col5:
-            macd_positive = len(df[df['MACD位階'] == '多頭'])
-            st.metric("MACD多頭", f"{macd_positive} 檔")
-        
-        # 市場分布
-        if '市場' in df.columns:
-            st.markdown("#### 📈 市場分布")
-            col1, col2 = st.columns(2)
-            with col1:
-                twse_count = len(df[df['市場'] == '上市'])
-                st.metric("上市", f"{twse_count} 檔")
-            with col2:
-                tpex_count = len(df[df['市場'] == '上櫃'])
-                st.metric("上櫃", f"{tpex_count} 檔")
-        
-        # 分類顯示結果
-        st.markdown("---")
-        
-        # 🔥 強勢訊號
-        strong = df[df['訊號強度'] >= 2]
-        if not strong.empty:
-            st.markdown("### 🔥 強勢訊號（多重確認）")
-            st.dataframe(strong, use_container_width=True, height=300)
-        
-        # ⚡ 中等訊號
-        medium = df[df['訊號強度'] == 1]
-        if not medium.empty:
-            st.markdown("### ⚡ 中等訊號（單一確認）")
-            st.dataframe(medium, use_container_width=True, height=300)
-        
-        # 💡 初期訊號
-        weak = df[df['訊號強度'] == 0]
-        if not weak.empty:
-            st.markdown("### 💡 初期訊號（僅MACD金叉）")
-            with st.expander("點擊展開查看"):
-                st.dataframe(weak, use_container_width=True, height=300)
-        
-        # 下載CSV
-        st.markdown("---")
-        csv = df.to_csv(index=False, encoding='utf-8-sig')
-        st.download_button(
-            label="📥 下載完整結果 (CSV)",
-            data=csv,
-            file_name=f"monthly_macd_full_scan_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
-            mime="text/csv"
-        )
-        
-        # 個股詳細分析
-        st.markdown("---")
-        st.markdown("### 🔍 個股詳細分析")
-        
-        stock_options = [f"{row['股票代號']} - {row['股票名稱']} ({row['市場']})" 
-                        for _, row in df.iterrows()]
+            tpex_count = len(df[df['市場'] == '上櫃'])
+            st.metric("上櫃", f"{tpex_count} 檔")
+    
+    # 產業分布
+    industry_summary = summarize_by_industry(df)
+    if not industry_summary.empty:
+        st.markdown("#### 🏭 產業分布")
+        col1, col2 = st.columns([3, 2])
+        with col1:
+            st.dataframe(industry_summary, use_container_width=True, height=300)
+        with col2:
+            st.bar_chart(industry_summary['訊號數'].head(15))
+    
+    # 分類顯示結果
+    st.markdown("---")
+    
+    # 🔥 強勢訊號
+    strong = df[df['訊號強度'] >= 2]
+    if not strong.empty:
+        st.markdown("### 🔥 強勢訊號（多重確認）")
+        st.dataframe(strong, use_container_width=True, height=300)
+    
+    # ⚡ 中等訊號
+    medium = df[df['訊號強度'] == 1]
+    if not medium.empty:
+        st.markdown("### ⚡ 中等訊號（單一確認）")
+        st.dataframe(medium, use_container_width=True, height=300)
+    
+    # 💡 初期訊號
+    weak = df[df['訊號強度'] == 0]
+    if not weak.empty:
+        st.markdown("### 💡 初期訊號（僅MACD金叉）")
+        with st.expander("點擊展開查看"):
+            st.dataframe(weak, use_container_width=True, height=300)
+    
+    # 與前次快照比較
+    render_snapshot_diff(df, filters, mode_key, current_tables or {}, snapshot_version or saved_version,
+                         universe_codes, industries)
+    
+    # 下載結果（與畫面相同的排序與篩選）
+    st.markdown("---")
+    csv_data = df.to_csv(index=False, encoding='utf-8-sig')
+    st.download_button(
+        label="📥 下載完整結果 (CSV)",
+        data=csv_data,
+        file_name=f"monthly_macd_full_scan_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+        mime="text/csv"
+    )
+
+    # 掃描時即時寫出的檔案：依發現順序、未套用畫面上的產業與排序
+    if export_sink is not None and os.path.isfile(export_sink.path):
+        with open(export_sink.path, 'rb') as f:
+            st.download_button(
+                label=f"📥 下載掃描即時匯出檔 ({export_sink.fmt.upper()}，依發現順序、未套用畫面篩選)",
+                data=f.read(),
+                file_name=os.path.basename(export_sink.path),
+                mime=export_sink.mime,
+                key='download_stream_export'
+            )
+        st.caption(f"💾 已即時匯出至 {export_sink.path}（{export_sink.count} 筆）")
+    
+    # 個股詳細分析
+    st.markdown("---")
+    st.markdown("### 🔍 個股詳細分析")
+    
+    stock_options = [f"{row['股票代號']} - {row['股票名稱']} ({row['市場']})" 
+                    for _, row in df.iterrows()]
+    
+    if stock_options:
+        selected_stock = st.selectbox("選擇股票查看月線圖", stock_options)
         
-        if stock_options:
-            selected_stock = st.selectbox("選擇股票查看月線圖", stock_options)
+        if selected_stock:
+            stock_code = selected_stock.split(' - ')[0]
+            stock_name = selected_stock.split(' - ')[1].split(' (')[0]
+            market = selected_stock.split('(')[1].split(')')[0]
+            
+            # 抓取該股票的月線數據
+            if market == '上市':
+                full_code = f"{stock_code}.TW"
+            else:
+                full_code = f"{stock_code}.TWO"
             
-            if selected_stock:
-                stock_code = selected_stock.split(' - ')[0]
-                stock_name = selected_stock.split(' - ')[1].split(' (')[0]
-                market = selected_stock.split('(')[1].split(')')[0]
+            data = StockScanner.fetch_monthly_data(full_code)
+            
+            if data is not None:
+                # 計算指標
+                data = StockScanner.calculate_monthly_macd(data)
+                data = StockScanner.calculate_monthly_kd(data)
+                data = StockScanner.calculate_monthly_rsi(data)
                 
-                # 抓取該股票的月線數據
-                if market == '上市':
-                    full_code = f"{stock_code}.TW"
-                else:
-                    full_code = f"{stock_code}.TWO"
+                # 顯示該股詳細資訊
+                stock_info = df[df['股票代號'] == stock_code].iloc[0]
                 
-                data = StockScanner.fetch_monthly_data(full_code)
+                col1, col2, col3, col4, col5 = st.columns(5)
+                with col1:
+                    st.metric("市場", stock_info['市場'])
+                with col2:
+                    st.metric("現價", f"${stock_info['現價']:.2f}")
+                with col3:
+                    st.metric("月MACD", f"{stock_info['月MACD']:.4f}")
+                with col4:
+                    st.metric("訊號強度", f"{stock_info['訊號強度']}")
+                with col5:
+                    st.metric("MACD位階", stock_info['MACD位階'])
                 
-                if data is not None:
-                    # 計算指標
-                    data = StockScanner.calculate_monthly_macd(data)
-                    data = StockScanner.calculate_monthly_kd(data)
-                    data = StockScanner.calculate_monthly_rsi(data)
-                    
-                    # 顯示該股詳細資訊
-                    stock_info = df[df['股票代號'] == stock_code].iloc[0]
-                    
-                    col1, col2, col3, col4, col5 = st.columns(5)
-                    with col1:
-                        st.metric("市場", stock_info['市場'])
-                    with col2:
-                        st.metric("現價", f"${stock_info['現價']:.2f}")
-                    with col3:
-                        st.metric("月MACD", f"{stock_info['月MACD']:.4f}")
-                    with col4:
-                        st.metric("訊號強度", f"{stock_info['訊號強度']}")
-                    with col5:
-                        st.metric("MACD位階", stock_info['MACD位階'])
-                    
-                    st.info(f"✅ 確認訊號: {stock_info['確認訊號']}")
-                    
-                    # 繪製圖表
-                    fig = plot_monthly_chart(data, stock_code, stock_name)
-                    st.pyplot(fig)
-                else:
-                    st.error("無法載入該股票的月線數據")
-        
-        # 投資建議
-        st.markdown("---")
-        st.markdown("### 💡 投資建議")
-        
-        st.markdown("""
-        #### 🎯 完整掃描結果解讀：
-        
-        1. **優先順序**
-           - 🔥 強勢訊號 > ⚡ 中等訊號 > 💡 初期訊號
-           - MACD > 0 > MACD < 0
-           - K值低檔（<30）> 中檔（30-60）> 高檔（>60）
-        
-        2. **市場差異**
-           - 上市股：流動性佳，資訊透明
-           - 上櫃股：波動較大，需注意流動性
-        
-        3. **產業分散**
-           - 不要集中單一產業
-           - 建議配置 3-5 個不同產業
-        
-        4. **進場策略**
-           - 分批進場（3-5次）
-           - 第一批：強勢訊號 30%
-           - 第二批：週線確認 30%
-           - 第三批：突破前高 40%
-        
-        5. **風險控管**
-           - 單一股票不超過總資金 20%
-           - 設定停損：跌破前月低 5-8%
-           - 定期檢視（每月一次）
-        """)
+                st.info(f"✅ 確認訊號: {stock_info['確認訊號']}")
+                
+                # 繪製圖表
+                fig = plot_monthly_chart(data, stock_code, stock_name)
+                st.pyplot(fig)
+            else:
+                st.error("無法載入該股票的月線數據")
     
+    # 投資建議
+    st.markdown("---")
+    st.markdown("### 💡 投資建議")
+    
+    st.markdown("""
+    #### 🎯 完整掃描結果解讀：
+    
+    1. **優先順序**
+       - 🔥 強勢訊號 > ⚡ 中等訊號 > 💡 初期訊號
+       - MACD > 0 > MACD < 0
+       - K值低檔（<30）> 中檔（30-60）> 高檔（>60）
+    
+    2. **市場差異**
+       - 上市股：流動性佳，資訊透明
+       - 上櫃股：波動較大，需注意流動性
+    
+    3. **產業分散**
+       - 不要集中單一產業
+       - 建議配置 3-5 個不同產業
+    
+    4. **進場策略**
+       - 分批進場（3-5次）
+       - 第一批：強勢訊號 30%
+       - 第二批：週線確認 30%
+       - 第三批：突破前高 40%
+    
+    5. **風險控管**
+       - 單一股票不超過總資金 20%
+       - 設定停損：跌破前月低 5-8%
+       - 定期檢視（每月一次）
+    """)
+
+
+def render_snapshot_diff(df, filters, mode_key, current_tables, current_version, universe_codes=None,
+                         industries=None):
+    """與任一前次快照比較：新增 / 消失 / 綠柱縮短升級為第一根紅柱 / 強度變化"""
+    store = SnapshotStore()
+    # 只列出含有同一模式結果、且完整掃描的快照；缺少該模式的表不能當成「沒有訊號」來比較。
+    # 沒有記錄掃描範圍的舊即時快照存的是篩選後的結果，也不列入
+    prior_versions = []
+    for version in store.list_versions():
+        manifest = store.load_manifest(version) or {}
+        if version == current_version or mode_key not in manifest.get('modes', {}) or manifest.get('partial'):
+            continue
+        if manifest.get('source') == 'live' and 'universe' not in manifest:
+            continue
+        prior_versions.append(version)
+    st.markdown("---")
+    st.markdown("### 🔄 與前次快照比較")
+    if not prior_versions:
+        st.info("💡 尚無含此模式的完整前次快照可比較（每次掃描與每日排程都會自動保存快照）")
+        return
+
+    def version_label(version):
+        manifest = store.load_manifest(version) or {}
+        source = {'live': '即時掃描', 'shard': '分片掃描'}.get(manifest.get('source'), '排程快照')
+        return f"{version}（{source}）"
+
+    prior_version = st.selectbox("選擇要比較的快照", prior_versions, format_func=version_label)
+    prior_tables = store.load_tables(prior_version)
+    prior_universe_codes = store.universe(prior_version)
+    # 前次結果套用相同的篩選條件；綠柱縮短表只用來判斷升級，不篩選
+    if mode_key in prior_tables:
+        prior = apply_result_filters(prior_tables[mode_key], **filters)
+        if industries and '產業' in prior.columns:
+            prior = prior[prior['產業'].isin(industries)]
+        prior_tables[mode_key] = prior
+    current_tables = dict(current_tables, **{mode_key: df})
+
+    diff = diff_snapshots(current_tables, prior_tables, mode_key, universe_codes, prior_universe_codes)
+    if universe_codes is not None and prior_universe_codes is not None:
+        common = len(universe_codes & prior_universe_codes)
+        if common < max(len(universe_codes), len(prior_universe_codes)):
+            st.caption(f"ℹ️ 兩次掃描範圍不同，只比較兩次都掃描過的 {common} 檔股票")
+    changed = diff[diff['變化'] != '➖ 持續']
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("🆕 新增", f"{(diff['變化'] == '🆕 新增').sum()} 檔")
+    with col2:
+        st.metric("❌ 消失", f"{(diff['變化'] == '❌ 消失').sum()} 檔")
+    with col3:
+        st.metric("⬆️ 升級", f"{diff['變化'].str.startswith('⬆️').sum()} 檔")
+    with col4:
+        st.metric("強度變化", f"{diff['變化'].isin(['📈 強度增加', '📉 強度減少']).sum()} 檔")
+
+    if changed.empty:
+        st.info("與所選快照相比沒有變化")
     else:
-        # 初始畫面
-        st.markdown("""
-        ### 👋 歡迎使用完整版月MACD掃描器！
-        
-        #### ⭐ 完整版特色：
-        
-        - ✅ **支援全部上市櫃股票**（約1900檔）
-        - ✅ **快速/完整雙模式**
-        - ✅ **即時顯示掃描結果**
-        - ✅ **自動抓取最新股票清單**
-        - ✅ **市場分類統計**
-        
-        #### 🚀 兩種掃描模式：
-        
-        | 模式 | 股票數 | 時間 | 適合對象 |
-        |------|--------|------|----------|
-        | 🚀 快速模式 | ~70檔 | 3-5分鐘 | 日常監控 |
-        | 🔍 完整模式 | ~1900檔 | 30-60分鐘 | 深度挖掘 |
-        
-        #### 💡 使用建議：
-        
-        1. **平時用快速模式**
-           - 涵蓋主要權值股、熱門股
-           - 快速掌握市場動態
-        
-        2. **週末用完整模式**
-           - 挖掘冷門潛力股
-           - 全面性的市場掃描
-        
-        3. **搭配使用效果最佳**
-           - 快速模式做日常監控
-           - 完整模式做週末研究
-        
-        #### 📊 掃描範圍：
-        
-        **快速模式（70檔）**
-        - 🏢 大型權值股（台積電、鴻海等）
-        - 💻 熱門電子股
-        - 🚢 航運三雄
-        - 🏦 金融股
-        - 🏭 傳產龍頭
-        
-        **完整模式（1900檔）**
-        - 📈 所有上市股票（~1000檔）
-        - 📉 所有上櫃股票（~900檔）
-        - 🔍 包含冷門、小型股
-        
-        ---
-        
-        ### 🎯 開始使用：
-        
-        1. 在左側選擇「快速模式」或「完整模式」
-        2. 設定篩選條件（建議先用預設值）
-        3. 點擊「🚀 開始掃描」
-        4. 等待掃描完成
-        5. 查看結果並下載 CSV
-        
-        準備好了嗎？選擇模式後點擊開始掃描吧！ 🚀
-        """)
+        st.dataframe(changed, use_container_width=True, height=300)
+
+
+def render_welcome():
+    """初始畫面"""
+    st.markdown("""
+    ### 👋 歡迎使用完整版月MACD掃描器！
+    
+    #### ⭐ 完整版特色：
+    
+    - ✅ **支援全部上市櫃股票**（約1900檔）
+    - ✅ **快速/完整雙模式**
+    - ✅ **即時顯示掃描結果**
+    - ✅ **自動抓取最新股票清單**
+    - ✅ **市場分類統計**
+    - ✅ **收盤後預先計算快照**（`python stock_macd2.py precompute`，開啟即看結果）
+    - ✅ **分片平行掃描**（`python stock_macd2.py shard-local --workers 4`，或多台機器共用佇列目錄）
+    
+    #### 🚀 兩種掃描模式：
+    
+    | 模式 | 股票數 | 時間 | 適合對象 |
+    |------|--------|------|----------|
+    | 🚀 快速模式 | ~70檔 | 3-5分鐘 | 日常監控 |
+    | 🔍 完整模式 | ~1900檔 | 30-60分鐘 | 深度挖掘 |
+    
+    #### 💡 使用建議：
+    
+    1. **平時用快速模式**
+       - 涵蓋主要權值股、熱門股
+       - 快速掌握市場動態
+    
+    2. **週末用完整模式**
+       - 挖掘冷門潛力股
+       - 全面性的市場掃描
+    
+    3. **搭配使用效果最佳**
+       - 快速模式做日常監控
+       - 完整模式做週末研究
+    
+    #### 📊 掃描範圍：
+    
+    **快速模式（70檔）**
+    - 🏢 大型權值股（台積電、鴻海等）
+    - 💻 熱門電子股
+    - 🚢 航運三雄
+    - 🏦 金融股
+    - 🏭 傳產龍頭
+    
+    **完整模式（1900檔）**
+    - 📈 所有上市股票（~1000檔）
+    - 📉 所有上櫃股票（~900檔）
+    - 🔍 包含冷門、小型股
+    
+    ---
+    
+    ### 🎯 開始使用：
+    
+    1. 在左側選擇「快速模式」或「完整模式」
+    2. 設定篩選條件（建議先用預設值）
+    3. 點擊「🚀 開始掃描」
+    4. 等待掃描完成
+    5. 查看結果並下載 CSV
+    
+    準備好了嗎？選擇模式後點擊開始掃描吧！ 🚀
+    """)
+
+
+def parse_int_list(text):
+    """把「8, 12, 16」這類輸入轉成整數 list（忽略無法解析的項目）"""
+    values = []
+    for part in text.replace('，', ',').split(','):
+        part = part.strip()
+        if part.isdigit() and int(part) > 0:
+            values.append(int(part))
+    return sorted(set(values))
+
+
+def render_parameter_sweep_page():
+    """參數掃描頁：比較不同 MACD / KD / RSI 參數下的訊號數與後續報酬"""
+    with st.sidebar:
+        st.header("🧪 參數掃描設定")
+        universe = st.radio(
+            "股票範圍",
+            ["🚀 快速模式（約70檔精選股）", "🔍 完整模式（全部上市櫃）"],
+            index=0,
+        )
+        fast_text = st.text_input("MACD 快線週期", "6, 12, 18")
+        slow_text = st.text_input("MACD 慢線週期", "20, 26, 35")
+        signal_text = st.text_input("MACD 訊號線週期", "6, 9, 12")
+        kd_text = st.text_input("KD 週期", "9")
+        rsi_text = st.text_input("RSI 週期", "6, 14")
+        start_sweep = st.button("🧪 開始參數掃描", type="primary", use_container_width=True)
+        st.caption(f"使用近 {SWEEP_PERIOD} 月線；已下載過的股票直接使用共用快取")
+
+    st.markdown("### 🧪 MACD 參數掃描")
+    if not start_sweep:
+        st.info("💡 在左側輸入要比較的參數（以逗號分隔），按下「開始參數掃描」。"
+                "所有參數組合在同一次向量化計算中完成，不會逐組重跑。")
+        return
+
+    fast_spans = parse_int_list(fast_text)
+    slow_spans = parse_int_list(slow_text)
+    signal_spans = parse_int_list(signal_text)
+    kd_periods = parse_int_list(kd_text) or [9]
+    rsi_periods = parse_int_list(rsi_text) or [14]
+    if not (fast_spans and slow_spans and signal_spans):
+        st.error("❌ 請至少輸入一組 MACD 快線、慢線、訊號線週期")
+        return
+
+    if "🚀 快速模式" in universe:
+        stock_dict = StockListFetcher.get_preset_stocks()
+    else:
+        stock_dict = StockListFetcher.get_all_tw_stocks()
+    if not stock_dict:
+        st.error("❌ 無法取得股票清單，請檢查網路連線")
+        return
+
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+
+    def on_progress(idx, total, stock_code):
+        progress_bar.progress(idx / total)
+        status_text.text(f'載入月線: {idx}/{total}  {stock_code}')
+
+    start_time = datetime.now()
+    panel = IndicatorPanel.build(list(stock_dict.keys()), progress_callback=on_progress)
+    progress_bar.empty()
+    status_text.empty()
+    if panel['Close'].empty:
+        st.error("❌ 無法載入任何月線資料")
+        return
+
+    report = ParameterSweep.run(
+        panel,
+        fast_spans=fast_spans, slow_spans=slow_spans, signal_spans=signal_spans,
+        kd_periods=kd_periods, rsi_periods=rsi_periods,
+    )
+    elapsed_time = (datetime.now() - start_time).total_seconds()
+    if report.empty:
+        st.warning("⚠️ 沒有有效的參數組合（快線需小於慢線），或歷史資料不足")
+        return
+
+    main_horizon = SWEEP_HORIZONS[len(SWEEP_HORIZONS) // 2]
+    sort_col = f'平均報酬{main_horizon}M%'
+    report = report.sort_values(sort_col, ascending=False)
+
+    st.success(f"✅ 完成 {len(report)} 組參數、{panel['Close'].shape[1]} 檔股票，耗時 {elapsed_time:.1f} 秒")
+
+    st.markdown(f"#### 📈 各組參數的訊號數與後續報酬（依{sort_col}排序）")
+    st.dataframe(report, use_container_width=True, height=400)
+
+    # 只看 MACD 參數（KD / RSI 週期不影響訊號數）
+    macd_view = report.drop_duplicates(['快線', '慢線', '訊號線']).copy()
+    macd_view.index = [f"{r['快線']}/{r['慢線']}/{r['訊號線']}" for _, r in macd_view.iterrows()]
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("##### 🔢 訊號數")
+        st.bar_chart(macd_view['訊號數'])
+    with col2:
+        st.markdown(f"##### 💹 {sort_col}")
+        st.bar_chart(macd_view[sort_col])
+
+    st.download_button(
+        label="📥 下載參數掃描結果 (CSV)",
+        data=report.to_csv(index=False, encoding='utf-8-sig'),
+        file_name=f"macd_parameter_sweep_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+        mime="text/csv"
+    )
+
+
+def render_market_breadth_page():
+    """市場廣度頁：全市場紅柱 / 第一根紅柱 / 綠柱縮短比例的月度走勢"""
+    with st.sidebar:
+        st.header("📊 市場廣度設定")
+        universe = st.radio(
+            "股票範圍",
+            ["🚀 快速模式（約70檔精選股）", "🔍 完整模式（全部上市櫃）"],
+            index=1,
+        )
+        period_label = st.selectbox("歷史長度", list(BREADTH_PERIODS.keys()), index=1)
+        breadth = MarketBreadth(
+            universe='quick' if "🚀 快速模式" in universe else 'full',
+            period=BREADTH_PERIODS[period_label],
+        )
+        refresh = st.button("🔄 更新市場廣度", type="primary", use_container_width=True)
+        if breadth.state and breadth.state.get('month'):
+            st.caption(f"已存檔至 {breadth.state['month']}，更新時只計算之後的新月份")
+
+    st.markdown("### 📊 市場廣度（月MACD柱狀體）")
+
+    if refresh:
+        if "🚀 快速模式" in universe:
+            stock_dict = StockListFetcher.get_preset_stocks()
+        else:
+            stock_dict = StockListFetcher.get_all_tw_stocks()
+        if not stock_dict:
+            st.error("❌ 無法取得股票清單，請檢查網路連線")
+            return
+
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+
+        def on_progress(idx, total, stock_code):
+            progress_bar.progress(idx / total)
+            status_text.text(f'載入月線: {idx}/{total}  {stock_code}')
+
+        panel = IndicatorPanel.build(
+            list(stock_dict.keys()), period=BREADTH_PERIODS[period_label], progress_callback=on_progress
+        )
+        progress_bar.empty()
+        status_text.empty()
+        series = breadth.update(panel)
+        breadth.save()
+    else:
+        series = breadth.series()
+
+    if series.empty:
+        st.info("💡 尚未計算市場廣度，請按左側「🔄 更新市場廣度」")
+        return
+
+    latest_month = series['月份'].max()
+    latest = series[series['月份'] == latest_month].set_index('市場')
+    st.markdown(f"#### 📅 {latest_month}{'（當月暫定）' if '暫定' in latest.columns and latest['暫定'].eq(True).any() else ''}")
+    cols = st.columns(len(MarketBreadth.METRICS))
+    for col, metric in zip(cols, MarketBreadth.METRICS):
+        with col:
+            if '全市場' in latest.index:
+                st.metric(metric.rstrip('%'), f"{latest.loc['全市場', metric]:.1f}%")
+
+    for metric in MarketBreadth.METRICS:
+        st.markdown(f"##### {metric.rstrip('%')}比例（%）")
+        st.line_chart(series.pivot(index='月份', columns='市場', values=metric))
+
+    with st.expander("查看明細"):
+        st.dataframe(series, use_container_width=True, height=300)
+
+
+def run_cli(argv):
+    """命令列入口（不經過 Streamlit）"""
+    parser = argparse.ArgumentParser(description='台股月MACD掃描器 - 命令列工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    precompute_parser = subparsers.add_parser('precompute', help='收盤後預先計算三種模式的掃描快照')
+    precompute_parser.add_argument('--once', action='store_true', help='立即執行一次後結束（不進入排程）')
+    precompute_parser.add_argument('--run-at', default=PRECOMPUTE_RUN_AT, help='每日執行時間 HH:MM（預設 %(default)s）')
+    precompute_parser.add_argument('--quick', action='store_true', help='只掃描快速模式的精選股票')
+
+    default_queue = os.path.join(SHARD_QUEUE_DIR, datetime.now().strftime('%Y%m%d_%H%M%S'))
+
+    plan_parser = subparsers.add_parser('shard-plan', help='把股票清單切成分片並寫入檔案式工作佇列')
+    plan_parser.add_argument('--queue', default=default_queue, help='佇列目錄（多台機器需放在共用磁碟）')
+    plan_parser.add_argument('--shards', type=int, default=8, help='分片數（預設 %(default)s）')
+    plan_parser.add_argument('--by', choices=['hash', 'market'], default='hash', help='分片方式（預設 %(default)s）')
+    plan_parser.add_argument('--mode', choices=list(SCAN_MODES), default='first_red', help='掃描模式（預設 %(default)s）')
+    plan_parser.add_argument('--incremental', action='store_true', help='使用月中增量模式')
+    plan_parser.add_argument('--quick', action='store_true', help='只掃描快速模式的精選股票')
+
+    worker_parser = subparsers.add_parser('shard-worker', help='領取並處理佇列中的分片，直到佇列清空')
+    worker_parser.add_argument('--queue', required=True, help='佇列目錄')
+    worker_parser.add_argument('--worker-id', default=None, help='worker 名稱（預設 主機名稱-PID）')
+    worker_parser.add_argument('--requeue-stale', action='store_true', help='開始前先把逾時未完成的分片放回佇列')
+
+    merge_parser = subparsers.add_parser('shard-merge', help='合併各分片的部分結果為最終排序表')
+    merge_parser.add_argument('--queue', required=True, help='佇列目錄')
+    merge_parser.add_argument('--publish', action='store_true', help='合併結果同時發布為最新快照')
+
+    local_parser = subparsers.add_parser('shard-local', help='在本機以多程序執行分片掃描並合併（不需外部服務）')
+    local_parser.add_argument('--queue', default=default_queue, help='佇列目錄')
+    local_parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2), help='程序數（預設 %(default)s）')
+    local_parser.add_argument('--shards', type=int, default=None, help='分片數（預設為程序數 × 4）')
+    local_parser.add_argument('--by', choices=['hash', 'market'], default='hash', help='分片方式（預設 %(default)s）')
+    local_parser.add_argument('--mode', choices=list(SCAN_MODES), default='first_red', help='掃描模式（預設 %(default)s）')
+    local_parser.add_argument('--incremental', action='store_true', help='使用月中增量模式')
+    local_parser.add_argument('--quick', action='store_true', help='只掃描快速模式的精選股票')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'precompute':
+        run_precompute_daemon(run_at=args.run_at, once=args.once, quick=args.quick)
+
+    elif args.command in ('shard-plan', 'shard-local'):
+        stock_dict = StockListFetcher.get_preset_stocks() if args.quick else StockListFetcher.get_all_tw_stocks()
+        if args.command == 'shard-plan':
+            count = ShardJobQueue(args.queue).plan(
+                stock_dict, args.shards, mode_key=args.mode, by=args.by, incremental=args.incremental
+            )
+            print(f'[shard] 已建立 {count} 個分片（{len(stock_dict)} 檔）於 {args.queue}')
+        else:
+            merged = run_local_shards(
+                stock_dict, args.workers, args.queue, mode_key=args.mode, by=args.by,
+                n_shards=args.shards, incremental=args.incremental,
+            )
+            print(f'[shard] 合併完成，共 {len(merged)} 檔，結果：{os.path.join(args.queue, "merged.csv")}')
+
+    elif args.command == 'shard-worker':
+        queue = ShardJobQueue(args.queue)
+        if args.requeue_stale:
+            print(f'[shard] 重新排入 {queue.requeue_stale()} 個逾時分片')
+        processed = run_shard_worker(args.queue, args.worker_id)
+        print(f'[shard] worker 結束，共處理 {processed} 個分片')
+
+    elif args.command == 'shard-merge':
+        queue = ShardJobQueue(args.queue)
+        status = queue.status()
+        if status['pending'] or status['running']:
+            print(f'[shard] 注意：尚有未完成的分片 {status}，只合併已完成的部分')
+        merged = queue.merge()
+        print(f'[shard] 合併完成，共 {len(merged)} 檔，結果：{os.path.join(args.queue, "merged.csv")}')
+        if args.publish:
+            jobs = queue.jobs('done')
+            mode_key = jobs[0]['mode'] if jobs else 'first_red'
+            # 只發布本次合併的模式，不混入其他日期的結果；其他模式仍由各自最新的快照提供
+            # 尚有未完成分片時標記為 partial，比較時不會被當成完整的前次結果
+            version = SnapshotStore().save(
+                {mode_key: merged},
+                meta={'source': 'shard', 'scanned': sum(len(job['stocks']) for job in jobs),
+                      'partial': bool(status['pending'] or status['running'])},
+                universe=[code for job in jobs for code in job['stocks']],
+            )
+            print(f'[shard] 已發布快照 {version}')
 
 
 if __name__ == "__main__":
-    main()
+    # streamlit run stock_macd2.py → 網頁介面；python stock_macd2.py <指令> → 命令列
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        main()